@@ -0,0 +1,504 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from tabulate import tabulate
+import utils
+
+
+# Dimensioni massime delle pagine restituite dalla Drive API e dalla Directory API
+MAX_PAGE_SIZES = {"drives": 100, "permissions": 100, "files": 1000, "users": 500, "changes": 1000}
+# Domini esterni usati per i permessi degli utenti ospiti
+EXTERNAL_DOMAINS = ["partner.example", "fornitore.example"]
+# Dimensioni dei domini sintetici predefiniti
+PRESETS = {
+    "small": {"drives": 200, "permissions": 10, "users": 2000, "files": 5},
+    "medium": {"drives": 1000, "permissions": 30, "users": 10000, "files": 10},
+    "large": {"drives": 5000, "permissions": 30, "users": 50000, "files": 10},
+}
+SCENARIOS = ["refresh", "users", "lookup", "rollout", "incremental"]
+
+
+class FakeDomain:
+    """
+    Dominio Google Workspace sintetico: drive condivisi con i loro permessi e file, utenti e gruppi.
+    Circa un drive su cinquanta non ha organizzatori, un utente su venticinque è sospeso
+    e una parte dei permessi è assegnata a utenti esterni
+    """
+
+    def __init__(self, drives, permissions, users, files, domain="example.com", page_size=None, seed=0):
+        rng = random.Random(seed)
+        self.domain = domain
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.changes = []
+        self.users = [{
+            "id": str(100000 + i),
+            "primaryEmail": f"user{i}@{domain}",
+            "aliases": [],
+            "name": {"fullName": f"Utente {i}"},
+            "isAdmin": i == 0,
+            "suspended": i % 25 == 24,
+        } for i in range(users)]
+        groups = [f"group{i}@{domain}" for i in range(max(1, users // 100))]
+
+        self.drives = {}
+        self.permissions = {}
+        self.files = {}
+        for d in range(drives):
+            drive_id = f"0AD{d:07d}"
+            self.drives[drive_id] = {"kind": "drive#drive", "id": drive_id, "name": f"Drive {d}"}
+            self.permissions[drive_id] = {}
+            if d % 50 != 49:
+                self._add_permission(drive_id, {"type": "user", "emailAddress": f"user0@{domain}", "role": "organizer"})
+            while len(self.permissions[drive_id]) < permissions:
+                kind = rng.random()
+                if kind < 0.15:
+                    permission = {"type": "group", "emailAddress": rng.choice(groups)}
+                elif kind < 0.2:
+                    permission = {"type": "user", "emailAddress": f"guest{rng.randrange(1000)}@{rng.choice(EXTERNAL_DOMAINS)}"}
+                else:
+                    permission = {"type": "user", "emailAddress": rng.choice(self.users)['primaryEmail']}
+                permission["role"] = rng.choice(utils.ROLES)
+                if not any(p['emailAddress'] == permission['emailAddress'] for p in self.permissions[drive_id].values()):
+                    self._add_permission(drive_id, permission)
+
+            folder_id = f"{drive_id}F"
+            self.files[drive_id] = [{"id": folder_id, "name": "Cartella", "mimeType": utils.FOLDER_MIME_TYPE,
+                                     "parents": [drive_id], "driveId": drive_id}]
+            for f in range(max(0, files - 1)):
+                self.files[drive_id].append({"id": f"{drive_id}-{f}", "name": f"File {f}", "mimeType": "text/plain",
+                                             "parents": [folder_id if f % 2 else drive_id], "driveId": drive_id})
+        self.children = {}
+        for drive_files in self.files.values():
+            for file in drive_files:
+                self.children.setdefault(file['parents'][0], []).append(file)
+
+    def _add_permission(self, drive_id, body):
+        self.next_id += 1
+        permission = {"kind": "drive#permission", "id": f"p{self.next_id}", **body}
+        self.permissions[drive_id][permission['id']] = permission
+        return permission
+
+    def _changed(self, drive_id):
+        self.changes.append({"kind": "drive#change", "changeType": "drive", "driveId": drive_id, "removed": False})
+
+    def handle(self, method, path, query, body):
+        """
+        Eseguire una richiesta alla API. Restituisce (stato, nome del metodo, risposta)
+        """
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["admin", "directory"] and parts[-1] == "users":
+            return 200, "directory.users.list", self._page("users", self.users, query)
+        if parts[:2] != ["drive", "v3"]:
+            return 404, "unknown", _error(404, "notFound", f"Percorso sconosciuto: {path}")
+        parts = parts[2:]
+
+        with self.lock:
+            if parts == ["drives"]:
+                return 200, "drive.drives.list", self._page("drives", list(self.drives.values()), query)
+            if len(parts) == 2 and parts[0] == "drives":
+                if parts[1] not in self.drives:
+                    return 404, "drive.drives.get", _error(404, "notFound", f"Shared drive not found: {parts[1]}")
+                return 200, "drive.drives.get", self.drives[parts[1]]
+            if parts == ["changes", "startPageToken"]:
+                return 200, "drive.changes.getStartPageToken", {"startPageToken": str(len(self.changes))}
+            if parts == ["changes"]:
+                start = int(query.get('pageToken', "0"))
+                response = self._page("changes", self.changes[start:], query)
+                if 'nextPageToken' in response:
+                    response['nextPageToken'] = str(start + int(response['nextPageToken']))
+                else:
+                    response['newStartPageToken'] = str(len(self.changes))
+                return 200, "drive.changes.list", response
+            if parts == ["files"]:
+                return 200, "drive.files.list", self._page("files", self._search_files(query), query)
+            if len(parts) >= 3 and parts[0] == "files" and parts[2] == "permissions":
+                drive_id = parts[1]
+                if drive_id not in self.permissions:
+                    return 404, "drive.permissions", _error(404, "notFound", f"File not found: {drive_id}")
+                permissions = self.permissions[drive_id]
+                if len(parts) == 3 and method == "GET":
+                    return 200, "drive.permissions.list", self._page("permissions", list(permissions.values()), query)
+                if len(parts) == 3 and method == "POST":
+                    if any(p.get('emailAddress') == body.get('emailAddress') and p.get('domain') == body.get('domain')
+                           for p in permissions.values()):
+                        return 400, "drive.permissions.create", _error(400, "invalidSharingRequest", "Permission already exists")
+                    self._changed(drive_id)
+                    return 200, "drive.permissions.create", self._add_permission(drive_id, body)
+                permission_id = parts[3]
+                if permission_id not in permissions:
+                    return 404, f"drive.permissions.{method.lower()}", _error(404, "notFound", f"Permission not found: {permission_id}")
+                self._changed(drive_id)
+                if method == "DELETE":
+                    del permissions[permission_id]
+                    return 204, "drive.permissions.delete", None
+                permissions[permission_id].update(role=body.get('role', permissions[permission_id]['role']))
+                return 200, "drive.permissions.update", permissions[permission_id]
+        return 404, "unknown", _error(404, "notFound", f"Percorso sconosciuto: {path}")
+
+    def _search_files(self, query):
+        q = query.get('q', "")
+        if " in parents" in q:
+            return self.children.get(q.split("'")[1], [])
+        if query.get('corpora') == "drive":
+            return self.files.get(query.get('driveId'), [])
+        if " in readers" in q:
+            email = q.split("'")[1]
+            return [file
+                    for drive_id, permissions in self.permissions.items()
+                    if any(p.get('emailAddress') == email for p in permissions.values())
+                    for file in self.files[drive_id]]
+        return [file for drive_files in self.files.values() for file in drive_files]
+
+    def _page(self, key, items, query):
+        max_size = MAX_PAGE_SIZES[key]
+        size = min(int(query.get('pageSize') or query.get('maxResults') or max_size), max_size, self.page_size or max_size)
+        start = int(query.get('pageToken') or 0) if key != "changes" else 0
+        response = {key: items[start:start + size]}
+        if start + size < len(items):
+            response['nextPageToken'] = str(start + size)
+        return response
+
+
+def _error(code, reason, message):
+    return {"error": {"code": code, "message": message, "errors": [{"domain": "global", "reason": reason, "message": message}]}}
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """
+    Server HTTP locale che emula la Drive API v3, la Directory API e le richieste batch,
+    con latenza ed errori di quota configurabili
+    """
+    daemon_threads = True
+
+    def __init__(self, address, domain, latency=0.0, part_latency=0.0, error_rate=0.0, retry_after=1, seed=0):
+        super().__init__(address, FakeApiHandler)
+        self.domain = domain
+        self.latency = latency
+        self.part_latency = part_latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, method, status):
+        with self.stats_lock:
+            stats = self.stats.setdefault(method, {"calls": 0, "errors": 0})
+            stats["calls"] += 1
+            if status >= 400:
+                stats["errors"] += 1
+
+    def throttle(self):
+        """
+        Decidere se rispondere con un errore di quota
+        """
+        with self.stats_lock:
+            return self.rng.random() < self.error_rate
+
+    def dispatch(self, method, target, body):
+        """
+        Eseguire una singola richiesta (anche se contenuta in un batch).
+        Restituisce (stato, header aggiuntivi, risposta)
+        """
+        url = urlsplit(target)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        payload = json.loads(body) if body and body.strip() else {}
+        if self.throttle():
+            self.count("throttled", 429)
+            return 403, {"Retry-After": str(self.retry_after)}, _error(403, "userRateLimitExceeded", "User Rate Limit Exceeded")
+        status, name, response = self.domain.handle(method, url.path, query, payload)
+        self.count(name, status)
+        return status, {}, response
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode("utf-8") if length else ""
+
+    def _send(self, status, content, content_type="application/json", headers=None):
+        data = content.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        body = self._body()
+        path = urlsplit(self.path).path
+        if path == "/_stats":
+            with self.server.stats_lock:
+                return self._send(200, json.dumps(self.server.stats))
+        if path == "/_reset":
+            with self.server.stats_lock:
+                self.server.stats = {}
+            return self._send(204, "")
+        time.sleep(self.server.latency)
+        if path.startswith("/batch"):
+            return self._batch(body)
+        status, headers, response = self.server.dispatch(self.command, self.path, body)
+        self._send(status, json.dumps(response) if response is not None else "", headers=headers)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _handle
+
+    def _batch(self, body):
+        """
+        Eseguire una richiesta batch (multipart/mixed) e rispondere con le risposte delle singole richieste
+        """
+        self.server.count("batch", 200)
+        message = Parser().parsestr(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n{body}")
+        boundary = "batch_benchmark"
+        parts = []
+        for part in message.get_payload():
+            request_line, serialized = part.get_payload().split("\n", 1)
+            method, target, _ = request_line.split(" ", 2)
+            request = Parser().parsestr(serialized)
+            time.sleep(self.server.part_latency)
+            status, headers, response = self.server.dispatch(method, target, request.get_payload())
+            content_id = part['Content-ID'][1:-1]
+            lines = [f"--{boundary}", "Content-Type: application/http", f"Content-ID: <response-{content_id}>", "",
+                     f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}", "Content-Type: application/json"]
+            lines += [f"{key}: {value}" for key, value in headers.items()]
+            lines += ["", json.dumps(response) if response is not None else ""]
+            parts.append("\r\n".join(lines))
+        self._send(200, "\r\n".join(parts + [f"--{boundary}--", ""]), f"multipart/mixed; boundary={boundary}")
+
+
+def serve(config, ports):
+    """
+    Avviare il server con un dominio sintetico (eseguito in un processo separato,
+    così che la memoria misurata sia solo quella del client)
+    """
+    domain = FakeDomain(config['drives'], config['permissions'], config['users'], config['files'],
+                        page_size=config['page_size'], seed=config['seed'])
+    server = FakeApiServer(("127.0.0.1", 0), domain, config['latency'], config['part_latency'],
+                           config['error_rate'], config['retry_after'], config['seed'])
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def build_services(root_url):
+    """
+    Costruire i client della Drive API e della Directory API che puntano al server locale
+    """
+    import httplib2
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+
+    services = []
+    for name, version in [("drive", "v3"), ("admin", "directory_v1")]:
+        document = json.loads(get_static_doc(name, version))
+        document['rootUrl'] = root_url
+        document.pop('mtlsRootUrl', None)
+        services.append(build_from_document(document, http=httplib2.Http()))
+    # I client del pool non aggiungono alcuna autorizzazione alle richieste
+    utils.HTTP_POOL.credentials = AnonymousCredentials()
+    return services
+
+
+def server_stats(root_url, reset=False):
+    """
+    Leggere (o azzerare) i contatori delle richieste ricevute dal server
+    """
+    import httplib2
+    if reset:
+        httplib2.Http().request(f"{root_url}_reset", "POST")
+        return {}
+    _, content = httplib2.Http().request(f"{root_url}_stats")
+    return json.loads(content)
+
+
+def run_scenario(name, function, root_url):
+    """
+    Eseguire uno scenario misurando tempo, richieste e picco di memoria
+    """
+    utils.reset_api_stats()
+    server_stats(root_url, reset=True)
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            detail = function()
+        finally:
+            sys.stdout = stdout
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "scenario": name,
+        "seconds": round(elapsed, 3),
+        "requests": utils.API_STATS['requests'],
+        "throttled": utils.API_STATS['throttled'],
+        "retried": utils.API_STATS['retried'],
+        "failed": utils.API_STATS['failed'],
+        "peak_mb": round(peak / 2 ** 20, 2),
+        "detail": detail,
+        "server": server_stats(root_url),
+        "methods": utils.METRICS.summary(),
+    }
+
+
+def scenarios(drive_service, directory_service, args):
+    """
+    Funzioni degli scenari: aggiornamento completo, utenti, ricerca dei membri,
+    aggiornamento dei permessi come nel menu [7] e aggiornamento incrementale
+    """
+    domain = "example.com"
+    members = [f"user{i}@{domain}" for i in range(1, args.lookups + 1)]
+
+    def refresh():
+        completed = utils.update_data(drive_service, workers=args.workers)
+        return {"completed": completed, "drives": len(utils.get_stored_drive_ids())}
+
+    def users():
+        return {"users": len(utils.get_all_users(directory_service, refresh=True))}
+
+    def lookup():
+        local = utils.get_drives_shared_with_members(drive_service, members)
+        remote, unsearched = utils.search_drives_shared_with_members(drive_service, members)
+        return {"members": len(members),
+                "local_drives": sum(map(len, local.values())),
+                "server_side_drives": sum(map(len, remote.values())),
+                "unsearched_drives": len(unsearched)}
+
+    def rollout():
+        drive_ids = utils.get_stored_drive_ids()[:args.rollout_drives]
+        new_permissions = [
+            {"email": f"user0@{domain}", "type": "user", "role": "organizer"},
+            {"email": f"group0@{domain}", "type": "group", "role": "writer"},
+            {"email": f"user1@{domain}", "type": "user", "role": "reader"},
+        ]
+        plan = utils.plan_permissions(drive_service, drive_ids, new_permissions, workers=args.workers)
+        results = utils.apply_permission_plan(drive_service, plan)
+        return {"drives": len(drive_ids), "operations": len(results),
+                "failed": sum(1 for result in results if not result['success'])}
+
+    def incremental():
+        return {"completed": utils.update_data(drive_service, incremental=True, workers=args.workers)}
+
+    return {"refresh": refresh, "users": users, "lookup": lookup, "rollout": rollout, "incremental": incremental}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Confrontare i risultati con quelli di riferimento.
+    Restituisce l'elenco delle regressioni oltre la tolleranza indicata
+    """
+    regressions = []
+    reference = {result['scenario']: result for result in baseline}
+    for result in results:
+        previous = reference.get(result['scenario'])
+        if not previous:
+            continue
+        for key in ["seconds", "requests", "peak_mb"]:
+            if previous[key] and result[key] > previous[key] * (1 + tolerance):
+                regressions.append(f"{result['scenario']}: {key} {previous[key]} -> {result[key]}")
+    return regressions
+
+
+def build_parser():
+    """
+    Costruire il parser degli argomenti della riga di comando
+    """
+    parser = argparse.ArgumentParser(description="Benchmark con un server locale che emula la Drive API e la Directory API")
+    parser.add_argument("--preset", choices=PRESETS, default="small", help="dimensioni del dominio sintetico")
+    parser.add_argument("--drives", type=int, help="numero di drive condivisi")
+    parser.add_argument("--permissions", type=int, help="permessi per drive")
+    parser.add_argument("--users", type=int, help="numero di utenti")
+    parser.add_argument("--files", type=int, help="file per drive")
+    parser.add_argument("--latency", type=float, default=0.02, help="latenza di ogni richiesta HTTP, in secondi")
+    parser.add_argument("--part-latency", type=float, default=0.002, help="latenza aggiuntiva per richiesta di un batch")
+    parser.add_argument("--page-size", type=int, help="dimensione massima delle pagine restituite")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="frazione di richieste con errore di quota")
+    parser.add_argument("--retry-after", type=float, default=1, help="attesa suggerita dopo un errore di quota")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=utils.WORKERS, help="richieste di lettura in parallelo")
+    parser.add_argument("--quota", type=float, default=1000, help="richieste al secondo consentite")
+    parser.add_argument("--lookups", type=int, default=10, help="membri cercati nello scenario lookup")
+    parser.add_argument("--rollout-drives", type=int, default=100, help="drive aggiornati nello scenario rollout")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"scenari da eseguire ({','.join(SCENARIOS)})")
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    parser.add_argument("--baseline", help="file JSON di un'esecuzione precedente con cui confrontare i risultati")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento consentito rispetto al riferimento")
+    return parser
+
+
+def main(argv):
+    args = build_parser().parse_args(argv)
+    config = dict(PRESETS[args.preset])
+    for key in config:
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    config.update(latency=args.latency, part_latency=args.part_latency, page_size=args.page_size,
+                  error_rate=args.error_rate, retry_after=args.retry_after, seed=args.seed)
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in selected if name not in SCENARIOS]
+    if unknown:
+        print(f"Scenari sconosciuti: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    print(f"Dominio sintetico: {config['drives']} drive x {config['permissions']} permessi, "
+          f"{config['users']} utenti, {config['files']} file per drive")
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(config, ports), daemon=True)
+    server.start()
+    root_url = f"http://127.0.0.1:{ports.get(timeout=600)}/"
+
+    workdir = tempfile.mkdtemp(prefix="drive_connect_benchmark_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    utils.RATE_LIMITER = utils.RateLimiter(args.quota)
+    try:
+        drive_service, directory_service = build_services(root_url)
+        functions = scenarios(drive_service, directory_service, args)
+        results = []
+        for name in selected:
+            print(f"Scenario {name}...")
+            results.append(run_scenario(name, functions[name], root_url))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.terminate()
+
+    print(tabulate([[result['scenario'], result['seconds'], result['requests'], result['throttled'], result['retried'],
+                     result['failed'], result['peak_mb'], json.dumps(result['detail'])] for result in results],
+                   headers=['Scenario', 'Secondi', 'Richieste', 'Limitate', 'Ritentate', 'Fallite', 'Memoria MB', 'Dettagli'],
+                   tablefmt="simple_grid"))
+    if args.output:
+        utils.save_to_file(args.output, results)
+
+    if args.baseline:
+        regressions = compare(results, utils.load_from_file(args.baseline) or [], args.tolerance)
+        if regressions:
+            print("\nRegressioni rispetto al riferimento:")
+            for regression in regressions:
+                print(f"- {regression}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
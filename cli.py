@@ -0,0 +1,308 @@
+import sys
+import json
+import argparse
+from contextlib import redirect_stdout
+import utils
+
+
+# Codici di uscita
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+def load_spec(filename):
+    """
+    Caricare un file di specifica YAML o JSON per apply-permissions, nel formato:
+
+    permissions:
+      - {email: utente@dominio.it, type: user, role: writer}
+    drives: all            # oppure un elenco di id
+    exclude: [id1, id2]    # facoltativo
+    """
+    with open(filename, 'r') as f:
+        if filename.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("Per le specifiche YAML è necessario installare PyYAML (pip install pyyaml)")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+
+    if not isinstance(spec, dict) or not isinstance(spec.get('permissions'), list):
+        raise ValueError("La specifica deve contenere l'elenco 'permissions'")
+    for permission in spec['permissions']:
+        if permission.get('type') not in ["user", "group", "domain"]:
+            raise ValueError(f"Tipo di permesso non valido: {permission}")
+        if permission.get('role') not in utils.ROLES:
+            raise ValueError(f"Ruolo non valido: {permission}")
+        if not permission.get('email'):
+            raise ValueError(f"Email mancante: {permission}")
+    drives = spec.get('drives', "all")
+    if drives != "all" and not isinstance(drives, list):
+        raise ValueError("'drives' deve essere 'all' o un elenco di id")
+    return spec
+
+
+def spec_file(filename):
+    """
+    Tipo argparse di --spec: il file viene caricato e validato prima dell'autenticazione,
+    così gli errori della specifica terminano con EXIT_USAGE
+    """
+    try:
+        return load_spec(filename)
+    except (ValueError, OSError) as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def refresh(drive_service, directory_service, args):
+    """
+    Aggiornare i dati salvati
+    """
+    completed = utils.update_data(drive_service, args.incremental, args.workers)
+    return {"completed": completed, "drives": len(utils.get_stored_drive_ids())}, completed
+
+
+def list_drives(drive_service, directory_service, args):
+    """
+    Elencare i drive condivisi
+    """
+    drives = utils.get_drive_models(drive_service, True)
+    if args.output:
+        count = utils.export_items(drives, args.output, utils.DRIVE_EXPORT_FIELDS, args.format, args.gzip)
+        return {"exported": count, "file": args.output}, True
+    return [drive.to_dict() for drive in drives], True
+
+
+def list_users(drive_service, directory_service, args):
+    """
+    Elencare gli utenti del dominio
+    """
+    users = utils.get_user_models(directory_service, args.refresh)
+    if args.output:
+        count = utils.export_items(users, args.output, utils.USER_EXPORT_FIELDS, args.format, args.gzip)
+        return {"exported": count, "file": args.output}, True
+    return [user.to_dict() for user in users], True
+
+
+def audit_member(drive_service, directory_service, args):
+    """
+    Elencare i drive condivisi con uno o più utenti/gruppi
+    """
+    if args.server_side:
+        # La ricerca diretta non trova i drive vuoti e quelli di cui l'utente autenticato non è membro
+        members_drives, unsearched = utils.search_drives_shared_with_members(drive_service, args.emails)
+        print(f"Attenzione: risultato parziale, {len(unsearched)} drive non cercati e drive vuoti esclusi")
+        return {"partial": True, "unsearched_drives": unsearched, "drives": members_drives}, True
+    return utils.get_drives_shared_with_members(drive_service, args.emails), True
+
+
+def audit(drive_service, directory_service, args):
+    """
+    Analizzare i permessi di tutti i drive e gli utenti del dominio
+    """
+    findings = utils.audit_domain(drive_service, directory_service, args.processes, args.domain)
+    if args.output:
+        count = utils.export_items(findings, args.output, utils.AUDIT_EXPORT_FIELDS, args.format, args.gzip)
+        return {"exported": count, "file": args.output}, True
+    return list(findings), True
+
+
+def snapshot(drive_service, directory_service, args):
+    """
+    Salvare una versione dei permessi attuali
+    """
+    snapshot_id = utils.take_snapshot(args.note)
+    if snapshot_id is None:
+        raise ValueError("Nessun permesso salvato: eseguire prima refresh")
+    return {"snapshot": snapshot_id}, True
+
+
+def list_snapshots(drive_service, directory_service, args):
+    """
+    Elencare le versioni dei permessi salvate
+    """
+    return utils.list_snapshots(), True
+
+
+def diff(drive_service, directory_service, args):
+    """
+    Confrontare i permessi di due versioni
+    """
+    changes = utils.diff_snapshots(args.old, args.new)
+    if args.output:
+        count = utils.export_items(changes, args.output, utils.DIFF_EXPORT_FIELDS, args.format, args.gzip)
+        return {"exported": count, "file": args.output}, True
+    return list(changes), True
+
+
+def apply_permissions(drive_service, directory_service, args):
+    """
+    Portare i permessi dei drive indicati nella specifica a quelli desiderati
+    """
+    spec = args.spec
+    # Le operazioni rimaste da un aggiornamento interrotto verrebbero eseguite prima del nuovo piano
+    counts = utils.count_permission_jobs()
+    pending = counts['pending'] + counts['running']
+    if pending and not args.dry_run:
+        if not args.discard_pending:
+            raise ValueError(f"Ci sono {pending} operazioni in sospeso: eseguire 'jobs --resume' "
+                             "oppure usare --discard-pending per annullarle")
+        utils.clear_permission_jobs("pending")
+        utils.clear_permission_jobs("running")
+    if spec.get('drives', "all") == "all":
+        drive_ids = [drive.id for drive in utils.get_drive_models(drive_service, True)]
+    else:
+        drive_ids = list(spec['drives'])
+    excluded = set(spec.get('exclude', []))
+    drive_ids = [drive_id for drive_id in drive_ids if drive_id not in excluded]
+
+    plan = utils.plan_permissions(drive_service, drive_ids, spec['permissions'], args.use_cache, args.workers)
+    counts = {"keep": 0, "update": 0, "create": 0, "delete": 0}
+    for operation in plan:
+        counts[operation['action']] += 1
+    output = {"drives": len(drive_ids), "plan": counts, "calls": len(plan) - counts['keep'], "dry_run": args.dry_run}
+    if args.dry_run:
+        output["operations"] = [operation for operation in plan if operation['action'] != "keep"]
+        return output, True
+
+    results = utils.apply_permission_plan(drive_service, plan, args.workers)
+    failed = [result for result in results if not result['success']]
+    output.update(succeeded=len(results) - len(failed), failed=failed)
+    return output, not failed
+
+
+def jobs(drive_service, directory_service, args):
+    """
+    Mostrare, riprendere o ritentare le operazioni sui permessi in coda
+    """
+    output = {}
+    if args.clear_dead:
+        output["cleared"] = utils.clear_permission_jobs("dead")
+    if args.retry_dead:
+        output["requeued"] = utils.retry_dead_permission_jobs()
+    success = True
+    if args.resume or args.retry_dead:
+        results = utils.run_permission_jobs(drive_service, args.workers)
+        failed = [result for result in results if not result['success']]
+        output.update(succeeded=len(results) - len(failed), failed=failed)
+        success = not failed
+    output.update(jobs=utils.count_permission_jobs(), dead=utils.get_permission_jobs("dead"))
+    return output, success
+
+
+def build_parser():
+    """
+    Costruire il parser degli argomenti della riga di comando
+    """
+    parser = argparse.ArgumentParser(prog="main.py", description="Gestione dei Drive condivisi senza menu interattivo")
+    parser.add_argument("--workers", type=int, default=utils.WORKERS, help="richieste di lettura in parallelo")
+    parser.add_argument("--quota", type=float, default=utils.QUOTA_PER_SECOND, help="richieste al secondo consentite")
+    parser.add_argument("--batch-size", type=int, default=utils.BATCH_SIZE, help="operazioni per richiesta batch")
+    parser.add_argument("--metrics-json", help="file JSON in cui esportare le misure delle richieste")
+    parser.add_argument("--metrics-prometheus", help="file di testo in cui esportare le misure nel formato di Prometheus")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    command = subparsers.add_parser("refresh", help="aggiorna i dati salvati")
+    command.add_argument("--incremental", action="store_true", help="aggiorna solo i drive modificati")
+    command.set_defaults(handler=refresh)
+
+    for name, handler, help in [("list-drives", list_drives, "elenca i drive condivisi"),
+                                ("list-users", list_users, "elenca gli utenti del dominio")]:
+        command = subparsers.add_parser(name, help=help)
+        command.add_argument("--output", help="file in cui esportare gli elementi invece di stamparli in JSON")
+        command.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+        command.add_argument("--gzip", action="store_true", help="comprime il file esportato")
+        if name == "list-users":
+            command.add_argument("--refresh", action="store_true", help="ignora gli utenti salvati")
+        command.set_defaults(handler=handler)
+
+    command = subparsers.add_parser("audit-member", help="elenca i drive condivisi con uno o più utenti/gruppi")
+    command.add_argument("emails", nargs="+")
+    command.add_argument("--server-side", action="store_true", help="cerca direttamente su Drive (risultato parziale: esclude i drive vuoti e quelli di cui non si è membri)")
+    command.set_defaults(handler=audit_member)
+
+    command = subparsers.add_parser("audit", help="report di accesso per l'intero dominio")
+    command.add_argument("--domain", action="append", default=[], help="dominio interno oltre a quelli degli utenti (ripetibile)")
+    command.add_argument("--processes", type=int, help="processi usati per i dati di grandi dimensioni (predefinito: numero di CPU)")
+    command.add_argument("--output", help="file in cui esportare il report invece di stamparlo in JSON")
+    command.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    command.add_argument("--gzip", action="store_true", help="comprime il file esportato")
+    command.set_defaults(handler=audit)
+
+    command = subparsers.add_parser("snapshot", help="salva una versione dei permessi attuali")
+    command.add_argument("--note", help="descrizione della versione")
+    command.set_defaults(handler=snapshot)
+
+    command = subparsers.add_parser("snapshots", help="elenca le versioni dei permessi salvate")
+    command.set_defaults(handler=list_snapshots)
+
+    command = subparsers.add_parser("diff", help="confronta i permessi di due versioni (predefinite: le ultime due)")
+    command.add_argument("old", type=int, nargs="?", help="id della versione meno recente")
+    command.add_argument("new", type=int, nargs="?", help="id della versione più recente")
+    command.add_argument("--output", help="file in cui esportare le differenze invece di stamparle in JSON")
+    command.add_argument("--format", choices=["csv", "jsonl"], default="csv")
+    command.add_argument("--gzip", action="store_true", help="comprime il file esportato")
+    command.set_defaults(handler=diff)
+
+    command = subparsers.add_parser("apply-permissions", help="applica i permessi di un file di specifica")
+    command.add_argument("--spec", required=True, type=spec_file, help="file YAML o JSON con i permessi desiderati")
+    command.add_argument("--dry-run", action="store_true", help="mostra le modifiche senza eseguirle")
+    command.add_argument("--use-cache", action="store_true", help="usa i permessi salvati come stato attuale")
+    command.add_argument("--discard-pending", action="store_true", help="annulla le operazioni in sospeso prima di applicare la specifica")
+    command.set_defaults(handler=apply_permissions)
+
+    command = subparsers.add_parser("jobs", help="operazioni sui permessi in coda")
+    command.add_argument("--resume", action="store_true", help="esegue le operazioni in sospeso")
+    command.add_argument("--retry-dead", action="store_true", help="rimette in coda ed esegue le operazioni fallite")
+    command.add_argument("--clear-dead", action="store_true", help="elimina le operazioni fallite")
+    command.set_defaults(handler=jobs)
+    return parser
+
+
+def main(argv):
+    """
+    Eseguire un comando senza menu interattivo e stampare il risultato in JSON.
+    I messaggi di avanzamento vengono scritti su stderr
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers deve essere almeno 1")
+    if not 1 <= args.batch_size <= utils.MAX_BATCH_SIZE:
+        parser.error(f"--batch-size deve essere compreso tra 1 e {utils.MAX_BATCH_SIZE}")
+    if args.quota <= 0:
+        parser.error("--quota deve essere maggiore di 0")
+    if getattr(args, "processes", None) is not None and args.processes < 1:
+        parser.error("--processes deve essere almeno 1")
+    utils.WORKERS = args.workers
+    utils.BATCH_SIZE = args.batch_size
+    utils.RATE_LIMITER = utils.RateLimiter(args.quota)
+
+    stdout = sys.stdout
+    try:
+        with redirect_stdout(sys.stderr):
+            drive_service, directory_service = utils.authenticate_services(interactive=False)
+            output, success = args.handler(drive_service, directory_service, args)
+    except ValueError as error:
+        print(f"Errore: {error}", file=sys.stderr)
+        return EXIT_USAGE
+    except utils.HttpError as error:
+        print(f"An error occurred: {error}", file=sys.stderr)
+        return EXIT_FAILED
+    except (OSError, RuntimeError) as error:
+        # Errori di rete dopo i tentativi, file non scrivibili o token mancante
+        print(f"Errore: {error}", file=sys.stderr)
+        return EXIT_FAILED
+
+    with redirect_stdout(sys.stderr):
+        utils.print_api_stats()
+    if args.metrics_json:
+        utils.METRICS.write_json(args.metrics_json)
+    if args.metrics_prometheus:
+        utils.METRICS.write_prometheus(args.metrics_prometheus)
+
+    json.dump({"result": output, "api": utils.API_STATS, "metrics": utils.METRICS.summary()}, stdout, indent=2, ensure_ascii=False)
+    stdout.write("\n")
+    return EXIT_OK if success else EXIT_FAILED
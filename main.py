@@ -1,10 +1,12 @@
+import sys
 import utils
-import re
+import cli
+from itertools import islice
+from collections import Counter
 from tabulate import tabulate
-from tqdm import tqdm
 from simple_term_menu import TerminalMenu
 from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import WordCompleter
+from prompt_toolkit.completion import Completer, Completion
 from prompt_toolkit.application.current import get_app
 
 
@@ -17,6 +19,92 @@ def prompt_autocomplete():
         buf.start_completion(select_first=False)
 
 
+class DriveCompleter(Completer):
+    """
+    Suggerire i drive condivisi durante la digitazione del nome, usando l'indice dei nomi
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    def get_completions(self, document, complete_event):
+        text = document.text_before_cursor
+        for label, drive in self.index.search(text):
+            yield Completion(label, start_position=-len(text), display_meta=drive.id)
+
+
+def prompt_drive(session, index):
+    """
+    Chiedere il nome di un drive condiviso con i suggerimenti e restituirne l'id
+    (None se non viene inserito nulla, "" se il drive non viene trovato)
+    """
+    text = session.prompt("Inserisci il nome del drive condiviso: ", completer=DriveCompleter(index), complete_while_typing=True)
+    if not text.strip():
+        return None
+    drive = index.resolve(text)
+    return drive.id if drive else ""
+
+
+def pause():
+    """
+    Stampare il riepilogo delle richieste eseguite dall'ultima azione e attendere l'utente
+    """
+    if utils.API_STATS['requests']:
+        print()
+        utils.print_api_stats()
+    input("\n\nPremi invio per continuare... ")
+
+
+def export(items, default_name, fields):
+    """
+    Chiedere formato, compressione e campi ed esportare gli elementi in un file
+    """
+    format = input("Formato del file? [csv/jsonl] ")
+    while format not in ["csv", "jsonl"]:
+        format = input("Formato del file? [csv/jsonl] ")
+    compress = input("Vuoi comprimere il file con gzip? [y/n] ") == 'y'
+    selected_fields = input(f"Campi da esportare separati da virgola [{','.join(fields)}] (invio per tutti): ")
+    if selected_fields:
+        selected_fields = [field.strip() for field in selected_fields.split(',')]
+        fields = {name: field for name, field in fields.items() if name in selected_fields}
+    file_name = f"{default_name}.{format}" + (".gz" if compress else "")
+    count = utils.export_items(items, file_name, fields, format, compress)
+    return file_name, count
+
+
+def print_source_counts(counts):
+    """
+    Stampare gli elementi trovati in ogni sorgente, i duplicati e gli eventuali errori
+    """
+    rows = [[source, count['elements'], count['duplicates'], count['error'] or ""] for source, count in counts.items()]
+    print(tabulate(rows, headers=['Sorgente', 'Elementi', 'Duplicati', 'Errore'], tablefmt="simple_grid"))
+
+
+def print_permission_results(results):
+    """
+    Stampare l'esito delle operazioni sui permessi e quelle fallite
+    """
+    failed = [result for result in results if not result['success']]
+    print(f"\nOperazioni completate con successo: {len(results) - len(failed)}/{len(results)}")
+    if failed:
+        failed_formatted = []
+        for result in failed:
+            target = result.get('email') or result.get('permission_id', 'N/A')
+            failed_formatted.append([result['drive_id'], result['action'], target, result['error']])
+        print(tabulate(failed_formatted, headers=['Drive', 'Operazione', 'Permesso', 'Errore'], tablefmt="simple_grid"))
+        print("Le operazioni fallite restano in coda: python3 main.py jobs --retry-dead per ritentarle")
+
+
+def list_elements(drive_service, folder_id, recursive=False, max_depth=None, drive_ids=()):
+    """
+    Elencare gli elementi di una cartella o di un drive condiviso, eventualmente con le sottocartelle
+    """
+    if recursive:
+        # I drive condivisi vengono elencati con un'unica interrogazione sull'intero drive
+        return utils.walk_folder(drive_service, folder_id, max_depth, fast=folder_id in drive_ids)
+    return utils.iter_files_in_folder(drive_service, folder_id)
+
+
 def main():
     session = PromptSession()
     main_menu_title = "  PYTHON DRIVE CONNECT\n  Premi Q o Esc per uscire \n"
@@ -30,8 +118,9 @@ def main():
         "[6] Rimuovi un permesso a un Drive condiviso",
         "[7] Aggiorna i permessi di più Drive condivisi",
         "[8] Visualizza gli utenti del dominio",
-        "[9] Disconnettiti",
-        "[10] Esci",
+        "[9] Report di accesso del dominio",
+        "[10] Disconnettiti",
+        "[11] Esci",
     ]
     main_menu_cursor = "> "
     main_menu_cursor_style = ("fg_cyan", "bold")
@@ -53,103 +142,117 @@ def main():
         
         while not main_menu_exit:
             main_sel = main_menu.show()
+            utils.reset_api_stats()
             
             # Ricaricare i dati
             if main_sel == 0:
-                utils.update_data(drive_service)
-                input("\n\nPremi invio per continuare... ")
+                incremental = False
+                if utils.get_metadata("start_page_token"):
+                    incremental = input("Vuoi aggiornare solo i drive modificati? [y/n] ") == 'y'
+                utils.update_data(drive_service, incremental)
+                print()
+                pause()
                 
             # Visualizzare i drive condivisi
             elif main_sel == 1:
-                drives = utils.get_all_drives(drive_service, True)
+                drives = utils.get_drive_models(drive_service, True)
                 drives_formatted = []
                 print(f"Drive trovati: {len(drives)}")
                 show_all = input("Vuoi visualizzare o esportare tutti i drive? [v/e] ")
                 if show_all == 'v':
                     print()
                     for drive in drives:
-                        id = drive.get('id', 'N/A')
-                        name = drive.get('name', 'N/A')
-                        drives_formatted.append([id, name])
+                        drives_formatted.append([drive.id, drive.name or 'N/A'])
                     print(tabulate(drives_formatted, headers=['Id', 'Nome'], tablefmt="simple_grid"))
-                    input("\n\nPremi invio per continuare... ")
+                    pause()
                 elif show_all == 'e':
-                    file_name = "shared_drives.csv"
-                    with open(file_name, 'w') as file:
-                        file.write("Id,Nome\n")
-                        for drive in drives:
-                            id = drive.get('id', 'N/A')
-                            name = drive.get('name', 'N/A')
-                            file.write(f"{id},{name}\n")
-                    print(f"Drive esportati in {file_name}")
-                    input("\n\nPremi invio per continuare... ")
+                    file_name, count = export(drives, "shared_drives", utils.DRIVE_EXPORT_FIELDS)
+                    print(f"{count} drive esportati in {file_name}")
+                    pause()
 
             # Visualizzare gli elementi presenti in un drive condiviso
             elif main_sel == 2:
                 
-                all_files = []
+                folder_ids = []
                 while True:
                     folder_id = input("Inserisci l'ID del drive condiviso: ")
                     if not folder_id:
                         break
-                    files = utils.get_files_in_folder(drive_service, folder_id)
-                    all_files.extend(files)
+                    folder_ids.append(folder_id)
+                
+                recursive = input("Vuoi includere anche le sottocartelle? [y/n] ") == 'y'
+                max_depth = None
+                drive_ids = set()
+                if recursive:
+                    depth = input("Profondità massima (invio per nessun limite): ")
+                    max_depth = int(depth) if depth else None
+                    drive_ids = set(utils.get_stored_drive_ids())
+                # Le sorgenti vengono elencate in parallelo, senza ripetere gli elementi presenti in più sorgenti
+                counts = {}
+                elements = utils.merge_listings({folder_id: list_elements(drive_service, folder_id, recursive, max_depth, drive_ids)
+                                                 for folder_id in dict.fromkeys(folder_ids)}, counts)
                 
-                files_formatted = []
                 print()
-                print(f"Elementi trovati: {len(all_files)}")
                 show_all = input("Vuoi visualizzare o esportare tutti gli elementi? [v/e] ")
                 if show_all == 'v':
-                    print()
-                    for element in all_files:
-                        id = element.get('id', 'N/A')
-                        name = element.get('name', 'N/A')
-                        files_formatted.append([id, name])
-                    print(tabulate(files_formatted, headers=['Id', 'Nome'], tablefmt="simple_grid"))
-                    input("\n\nPremi invio per continuare... ")
-                elif show_all == 'e':
-                    file_name = "elements.csv"
-                    with open(file_name, 'w') as file:
-                        file.write("Id,Nome\n")
-                        for element in all_files:
+                    # Ogni blocco di elementi viene mostrato non appena è stato recuperato
+                    count = 0
+                    while True:
+                        page = list(islice(elements, 100))
+                        if not page:
+                            break
+                        files_formatted = []
+                        for element in page:
                             id = element.get('id', 'N/A')
                             name = element.get('name', 'N/A')
-                            file.write(f"{id},{name}\n")
-                    print(f"Drive esportati in {file_name}")
-                    input("\n\nPremi invio per continuare... ")
+                            files_formatted.append([id, name])
+                        count += len(page)
+                        print()
+                        print(tabulate(files_formatted, headers=['Id', 'Nome'], tablefmt="simple_grid"))
+                    print(f"\nElementi trovati: {count}")
+                    print_source_counts(counts)
+                    pause()
+                elif show_all == 'e':
+                    # Gli elementi vengono scritti nel file man mano che le pagine vengono recuperate
+                    fields = utils.TREE_EXPORT_FIELDS if recursive else utils.FILE_EXPORT_FIELDS
+                    file_name, count = export(elements, "elements", fields)
+                    print(f"{count} elementi esportati in {file_name}")
+                    print_source_counts(counts)
+                    pause()
                     
             # Visualizzare i drive condivisi con un utente/gruppo
             elif main_sel == 3:
-                email = input("Inserisci l'email dell'utente/gruppo: ")
-                user_drives = utils.get_drives_shared_with_member(drive_service, email)
+                emails = input("Inserisci l'email dell'utente/gruppo (più email separate da virgola): ")
+                emails = [email.strip() for email in emails.split(',') if email.strip()]
+                server_side = input("Vuoi cercare direttamente su Drive invece che nei dati salvati? (risultato parziale) [y/n] ") == 'y'
+                if server_side:
+                    members_drives, unsearched = utils.search_drives_shared_with_members(drive_service, emails)
+                    print("Attenzione: risultato parziale, i drive vuoti non vengono trovati", end="")
+                    print(f" e {len(unsearched)} drive di cui non sei membro non sono stati cercati" if unsearched else "")
+                else:
+                    members_drives = utils.get_drives_shared_with_members(drive_service, emails)
                 user_drives_formatted = []
-                print(f"Drive trovati: {len(user_drives)}")
+                for email, user_drives in members_drives.items():
+                    print(f"Drive trovati per {email}: {len(user_drives)}")
                 show_all = input("Vuoi visualizzare tutti i drive? [y/n] ")
                 if show_all == 'y':
                     print()
-                    for drive in user_drives:
-                        id = drive.get('id', 'N/A')
-                        name = drive.get('name', 'N/A')
-                        user_drives_formatted.append([id, name])
-                    print(tabulate(user_drives_formatted, headers=['Id', 'Nome'], tablefmt="simple_grid"))
-                    input("\n\nPremi invio per continuare... ")
+                    for email, user_drives in members_drives.items():
+                        for drive in user_drives:
+                            id = drive.get('id', 'N/A')
+                            name = drive.get('name', 'N/A')
+                            user_drives_formatted.append([email, id, name])
+                    print(tabulate(user_drives_formatted, headers=['Email', 'Id', 'Nome'], tablefmt="simple_grid"))
+                    pause()
                     
             # Visualizzare i permessi di un drive condiviso
             elif main_sel == 4:
-                shared_drives = utils.get_all_drives(drive_service, True)
-                display_names = [f"{d['name']} [{d['id']}]" for d in shared_drives]
-                shared_drive_completer = WordCompleter(display_names, ignore_case=True)
-                shared_drive_name = session.prompt("Inserisci il nome del drive condiviso: ", completer=shared_drive_completer, complete_while_typing=True)
-                # Estrarre l'ID del drive condiviso
-                drive_id = None
-                matches = re.findall(r'\[.*?\]', shared_drive_name)
-                if matches:
-                    drive_id = matches[-1].strip('[]')
+                drive_id = prompt_drive(session, utils.get_drive_index(drive_service))
                 if not drive_id:
                     print("ID del drive condiviso non trovato.")
-                    input("\n\nPremi invio per continuare... ")
+                    pause()
                     continue
-                permissions = utils.get_drive_permissions(drive_service, drive_id)
+                permissions = utils.get_drive_permissions_cached(drive_service, drive_id)
                 permissions_formatted = []
                 print()
                 for permission in permissions:
@@ -159,7 +262,7 @@ def main():
                     role = permission.get('role', 'N/A')
                     permissions_formatted.append([id, email, type, role])
                 print(tabulate(permissions_formatted, headers=['Id', 'Email', 'Tipo', 'Ruolo'], tablefmt="simple_grid"))
-                input("\n\nPremi invio per continuare... ")
+                pause()
             
             # Aggiungere un permesso a un drive condiviso
             elif main_sel == 5:
@@ -176,7 +279,7 @@ def main():
                     print(f"Permesso aggiunto con successo")
                 else:
                     print(f"Errore durante l'aggiunta del permesso")
-                input("\n\nPremi invio per continuare... ")
+                pause()
             
             # Rimuovere un permesso a un drive condiviso
             elif main_sel == 6:
@@ -187,10 +290,23 @@ def main():
                     print(f"Permesso rimosso con successo")
                 else:
                     print(f"Errore durante la rimozione del permesso")
-                input("\n\nPremi invio per continuare... ")
+                pause()
             
             # Aggiornare i permessi di più drive condivisi
             elif main_sel == 7:
+                # Le operazioni di un aggiornamento interrotto restano in coda finché non vengono riprese o annullate
+                counts = utils.count_permission_jobs()
+                pending = counts['pending'] + counts['running']
+                if pending:
+                    choice = input(f"Ci sono {pending} operazioni in sospeso da un aggiornamento interrotto. Vuoi riprenderle o annullarle? [r/a] ")
+                    while choice not in ["r", "a"]:
+                        choice = input("Vuoi riprenderle o annullarle? [r/a] ")
+                    if choice == 'r':
+                        print_permission_results(utils.run_permission_jobs(drive_service))
+                        pause()
+                        continue
+                    utils.clear_permission_jobs("pending")
+                    utils.clear_permission_jobs("running")
                 new_permissions = []
                 num_permissions = input("Quanti permessi vuoi aggiungere? ")
                 for i in range(int(num_permissions)):
@@ -210,79 +326,87 @@ def main():
                     drives_exclusion = input("Vuoi escludere determinati drive? [y/n] ")
                     if drives_exclusion == 'y':
                         excluded_drives = []
-                        drives = utils.get_all_drives(drive_service, True)
-                        display_names = [f"{d['name']} [{d['id']}]" for d in drives]
-                        shared_drive_completer = WordCompleter(display_names, ignore_case=True)
+                        drives = utils.get_drive_models(drive_service, True)
+                        drive_index = utils.get_drive_index(drive_service)
                         print()
                         while True:
-                            excluded_drive_name = session.prompt("Inserisci il nome del drive condiviso: ", completer=shared_drive_completer, complete_while_typing=True)
-                            if not excluded_drive_name:
+                            drive_id = prompt_drive(session, drive_index)
+                            if drive_id is None:
                                 break
-                            # Estrarre l'ID del drive condiviso
-                            drive_id = None
-                            matches = re.findall(r'\[.*?\]', excluded_drive_name)
-                            if matches:
-                                drive_id = matches[-1].strip('[]')
                             if not drive_id:
                                 print("ID del drive condiviso non trovato.")
                                 input("\n\nPremi invio per continuare... ")
                                 continue
                             excluded_drives.append(drive_id)
-                        drives = [drive for drive in drives if drive['id'] not in excluded_drives]
+                        drives = [drive for drive in drives if drive.id not in excluded_drives]
                     else:
-                        drives = utils.get_all_drives(drive_service, True)
+                        drives = utils.get_drive_models(drive_service, True)
                 else:
                     for i in range(int(drives_affected)):
                         drive_id = input(f"Inserisci l'ID del {i+1}^ drive: ")
-                        drives.append({"id": drive_id})
+                        drives.append(utils.Drive(drive_id, None))
                 print()
-                if input(f"Sei sicuro di voler aggiornare i permessi di {len(drives)} drive? [y/n] ") == 'y':
-                    for drive in tqdm(drives):
-                        drive_id = drive.get('id', 'N/A')
-                        permissions = utils.get_drive_permissions(drive_service, drive_id)
-                        for permission in permissions:
-                            utils.delete_drive_permission(drive_service, drive_id, permission.get('id'))
-                        for permission in new_permissions:
-                            utils.create_drive_permission(drive_service, drive_id, permission.get('email'), permission.get('type'), permission.get('role'))
-                    input("\n\nPremi invio per continuare... ")
+                use_cache = input("Vuoi usare i permessi salvati localmente? [y/n] ") == 'y'
+                plan = utils.plan_permissions(drive_service, [drive.id for drive in drives], new_permissions, use_cache)
+                counts = {"keep": 0, "update": 0, "create": 0, "delete": 0}
+                for operation in plan:
+                    counts[operation['action']] += 1
+                changes = [operation for operation in plan if operation['action'] != "keep"]
+                print(f"\nPermessi invariati: {counts['keep']} - Da modificare: {counts['update']} - "
+                      f"Da aggiungere: {counts['create']} - Da rimuovere: {counts['delete']}")
+                print(f"Chiamate API necessarie: {len(changes)}")
+                if changes and input("Vuoi visualizzare le modifiche previste (dry-run)? [y/n] ") == 'y':
+                    changes_formatted = []
+                    for operation in changes:
+                        role = operation.get('role')
+                        if operation['action'] == "update":
+                            role = f"{operation['previous_role']} -> {role}"
+                        changes_formatted.append([operation['drive_id'], operation['action'], operation.get('email', 'N/A'), operation.get('type', 'N/A'), role])
+                    print(tabulate(changes_formatted, headers=['Drive', 'Operazione', 'Email', 'Tipo', 'Ruolo'], tablefmt="simple_grid"))
+                print()
+                if changes and input(f"Sei sicuro di voler aggiornare i permessi di {len(drives)} drive? [y/n] ") == 'y':
+                    print_permission_results(utils.apply_permission_plan(drive_service, plan))
+                    pause()
             
             # Visualizzare gli utenti del dominio
             elif main_sel == 8:
-                users = utils.get_all_users(directory_service)
+                users = utils.get_user_models(directory_service)
                 users_formatted = []
                 print(f"Utenti trovati: {len(users)}")
                 show_all = input("Vuoi visualizzare o esportare tutti gli utenti? [v/e] ")
                 if show_all == 'v':
                     print()
                     for user in users:
-                        id = user.get('id', 'N/A')
-                        email = user.get('primaryEmail', 'N/A')
-                        name = user.get('name', {}).get('fullName', 'N/A')
-                        is_admin = 'Sì' if user.get('isAdmin', False) else 'No'
-                        status = 'ATTIVO' if not user.get('suspended', False) else 'SOSPESO'
-                        users_formatted.append([id, email, name, is_admin, status])
+                        is_admin = 'Sì' if user.admin else 'No'
+                        status = 'ATTIVO' if not user.suspended else 'SOSPESO'
+                        users_formatted.append([user.id, user.email or 'N/A', user.name or 'N/A', is_admin, status])
                     print(tabulate(users_formatted, headers=['Id', 'Email', 'Nome', 'Admin', 'Stato'], tablefmt="simple_grid"))
-                    input("\n\nPremi invio per continuare... ")
+                    pause()
                 elif show_all == 'e':
-                    file_name = "users.csv"
-                    with open(file_name, 'w') as file:
-                        file.write("Id,Email,Nome,Admin,Stato\n")
-                        for user in users:
-                            id = user.get('id', 'N/A')
-                            email = user.get('primaryEmail', 'N/A')
-                            name = user.get('name', {}).get('fullName', 'N/A')
-                            is_admin = 'SI' if user.get('isAdmin', False) else 'NO'
-                            status = 'ATTIVO' if not user.get('suspended', False) else 'SOSPESO'
-                            file.write(f"{id},{email},{name},{is_admin},{status}\n")
-                    print(f"Utenti esportati in {file_name}")
-                    input("\n\nPremi invio per continuare... ")
+                    file_name, count = export(users, "users", utils.USER_EXPORT_FIELDS)
+                    print(f"{count} utenti esportati in {file_name}")
+                    pause()
                         
+            # Esportare il report di accesso dell'intero dominio
             elif main_sel == 9:
+                counts = Counter()
+
+                def counted(findings):
+                    for finding in findings:
+                        counts[finding['report']] += 1
+                        yield finding
+
+                file_name, count = export(counted(utils.audit_domain(drive_service, directory_service)), "audit", utils.AUDIT_EXPORT_FIELDS)
+                print(f"\n{count} righe esportate in {file_name}")
+                print(tabulate(counts.items(), headers=['Report', 'Righe'], tablefmt="simple_grid"))
+                pause()
+
+            elif main_sel == 10:
                 utils.delete_token()
                 utils.delete_data()
                 main_menu_exit = True
                 
-            elif main_sel == 10 or main_sel == None:
+            elif main_sel == 11 or main_sel == None:
                 main_menu_exit = True
             
       
@@ -291,4 +415,6 @@ def main():
 
 
 if __name__ == "__main__":
+  if len(sys.argv) > 1:
+    sys.exit(cli.main(sys.argv[1:]))
   main()
\ No newline at end of file
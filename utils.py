@@ -1,7 +1,30 @@
 import os
 import os.path
+import sys
+import csv
+import gzip
 import json
+import time
+import zlib
+import pickle
+import hashlib
+import itertools
+import queue
+import datetime
+import sqlite3
+import random
+import heapq
+import bisect
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+import httplib2
+import google_auth_httplib2
 from tqdm import tqdm
+from tabulate import tabulate
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -16,6 +39,428 @@ SCOPES = [
 ]
 # Percorso al file delle credenziali https://developers.google.com/people/quickstart/python?hl=it#authorize_credentials_for_a_desktop_application
 CREDENTIALS_FILE = "credentials.json"
+# Database locale con drive, permessi e utenti
+DATABASE_FILE = "drive_connect.db"
+# File JSON usati dalle versioni precedenti, importati nel database al primo avvio
+LEGACY_FILES = ["shared_drives.json", "permissions.json", "member_index.json", "users.json", "sync_state.json",
+                "refresh_checkpoint.json"]
+# Stato di avanzamento dell'aggiornamento completo, usato per riprenderlo dopo un'interruzione
+CHECKPOINT_FILE = "refresh_checkpoint.pickle"
+# Intervallo (in secondi) tra due salvataggi dello stato di avanzamento
+CHECKPOINT_INTERVAL = 30
+# Ruoli assegnabili ai membri di un drive condiviso
+ROLES = ["organizer", "fileOrganizer", "writer", "commenter", "reader"]
+# Numero massimo di richieste per singolo batch consentito dalla Drive API
+MAX_BATCH_SIZE = 100
+# Numero di richieste per singolo batch
+BATCH_SIZE = MAX_BATCH_SIZE
+# Numero predefinito di worker paralleli, letto a ogni chiamata (le funzioni ricevono workers=None)
+WORKERS = 8
+# Tipo MIME delle cartelle di Google Drive
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+# Campi dei file restituiti dalla visita delle cartelle
+WALK_FIELDS = ["id", "name", "mimeType", "parents"]
+# Elementi recuperati in attesa di essere restituiti durante l'elenco di più sorgenti
+MERGE_BUFFER = 1000
+# Numero di permessi oltre il quale l'audit del dominio viene suddiviso tra più processi
+AUDIT_PARALLEL_THRESHOLD = 200000
+# Gruppi di drive assegnati a ogni processo durante l'audit
+AUDIT_CHUNKS_PER_WORKER = 4
+# Durata (in secondi) della cache degli utenti del dominio
+USERS_CACHE_TTL = 3600
+# Campi degli utenti richiesti alla Directory API
+USER_FIELDS = "nextPageToken,users(id,primaryEmail,aliases,name/fullName,isAdmin,suspended)"
+# Numero massimo di drive suggeriti durante la digitazione del nome
+DRIVE_SUGGESTIONS = 20
+# Richieste al secondo consentite dalla quota del progetto
+QUOTA_PER_SECOND = 100
+# Numero massimo di nuovi tentativi per una richiesta limitata o fallita temporaneamente
+MAX_RETRIES = 6
+# Attesa massima (in secondi) tra due tentativi
+MAX_BACKOFF = 64
+# Errori per cui ha senso ritentare la richiesta
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Esecuzioni di un'operazione in coda sui permessi prima che venga considerata fallita definitivamente
+JOB_MAX_ATTEMPTS = 3
+# Secondi dopo i quali un'operazione presa in carico da un processo interrotto torna eseguibile
+JOB_CLAIM_TIMEOUT = 900
+RATE_LIMIT_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+# Anticipo (in secondi) con cui il token di accesso viene rinnovato prima della scadenza
+TOKEN_REFRESH_MARGIN = 300
+# Contatori delle richieste eseguite
+API_STATS = {"requests": 0, "throttled": 0, "retried": 0, "failed": 0}
+_stats_lock = threading.Lock()
+# Connessione al database locale, condivisa tra i thread
+_db = None
+_db_lock = threading.RLock()
+_transaction_depth = 0
+# Indice dei nomi dei drive, ricostruito quando cambia l'elenco dei drive salvati
+_drive_index = None
+# Drive, permessi e utenti salvati, letti dal database una sola volta e ricaricati quando cambiano
+_models = {}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS drives (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS permissions (
+    drive_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    email TEXT COLLATE NOCASE,
+    domain TEXT,
+    type TEXT,
+    role TEXT,
+    PRIMARY KEY (drive_id, id)
+);
+CREATE INDEX IF NOT EXISTS permissions_email ON permissions (email);
+CREATE INDEX IF NOT EXISTS permissions_role ON permissions (role);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    primary_email TEXT COLLATE NOCASE,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_emails (
+    email TEXT PRIMARY KEY COLLATE NOCASE,
+    user_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TEXT NOT NULL,
+    note TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshot_drives (
+    snapshot_id INTEGER NOT NULL,
+    drive_id TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (snapshot_id, drive_id)
+);
+CREATE TABLE IF NOT EXISTS permission_sets (
+    hash TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    drive_id TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    claimed REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, drive_id, id);
+"""
+
+
+def _intern(value):
+    """
+    Condividere un'unica copia delle stringhe ripetute (ruoli, tipi, email, domini)
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+@dataclass
+class Drive:
+    """
+    Drive condiviso salvato
+    """
+    __slots__ = ("id", "name")
+    id: str
+    name: str
+
+    def __reduce__(self):
+        return Drive, (self.id, self.name)
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name}
+
+
+@dataclass
+class Permission:
+    """
+    Permesso di un drive condiviso, con i soli campi usati dall'applicazione
+    """
+    __slots__ = ("id", "email", "domain", "type", "role")
+    id: str
+    email: str
+    domain: str
+    type: str
+    role: str
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*map(_intern, row))
+
+    @classmethod
+    def from_dict(cls, permission):
+        return cls.from_row([permission.get(key) for key in ["id", "emailAddress", "domain", "type", "role"]])
+
+    def __reduce__(self):
+        return Permission, (self.id, self.email, self.domain, self.type, self.role)
+
+    def to_dict(self):
+        return _permission_from_row((self.id, self.email, self.domain, self.type, self.role))
+
+
+@dataclass
+class User:
+    """
+    Utente del dominio, con i campi richiesti alla Directory API (USER_FIELDS)
+    """
+    __slots__ = ("id", "email", "aliases", "name", "admin", "suspended")
+    id: str
+    email: str
+    aliases: tuple
+    name: str
+    admin: bool
+    suspended: bool
+
+    @classmethod
+    def from_dict(cls, user):
+        return cls(user.get('id'), _intern(user.get('primaryEmail')), tuple(map(_intern, user.get('aliases', []))),
+                   user.get('name', {}).get('fullName'), user.get('isAdmin', False), user.get('suspended', False))
+
+    def __reduce__(self):
+        return User, (self.id, self.email, self.aliases, self.name, self.admin, self.suspended)
+
+    def to_dict(self):
+        user = {"id": self.id, "primaryEmail": self.email, "name": {"fullName": self.name},
+                "isAdmin": self.admin, "suspended": self.suspended}
+        if self.aliases:
+            user["aliases"] = list(self.aliases)
+        return user
+
+
+class RateLimiter:
+    """
+    Limitatore token bucket condiviso tra tutti i thread
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Attendere finché non sono disponibili i token richiesti.
+        Una richiesta che costa più della capacità attende il bucket pieno e lo lascia in debito
+        per l'intero costo, così anche i batch più grandi della quota rispettano il ritmo medio
+        """
+        needed = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= needed:
+                        self.tokens -= tokens
+                        return
+                    wait = (needed - self.tokens) / self.rate
+                else:
+                    wait = self.paused_until - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Sospendere tutte le richieste per il tempo indicato e svuotare il bucket
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.paused_until
+
+
+RATE_LIMITER = RateLimiter(QUOTA_PER_SECOND)
+
+
+class HttpPool:
+    """
+    Insieme di client HTTP autorizzati riutilizzabili.
+    httplib2 non è thread-safe: ogni client viene usato da un solo thread alla volta,
+    ma resta nel pool con le sue connessioni keep-alive aperte per le richieste successive
+    """
+
+    def __init__(self):
+        self.credentials = None
+        self.clients = queue.LifoQueue()
+
+    @contextmanager
+    def client(self):
+        """
+        Prendere in prestito un client HTTP, creandone uno nuovo se sono tutti in uso.
+        Senza credenziali impostate restituisce None (viene usato il client del servizio)
+        """
+        if self.credentials is None:
+            yield None
+            return
+        try:
+            http = self.clients.get_nowait()
+        except queue.Empty:
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+        try:
+            yield http
+        finally:
+            self.clients.put(http)
+
+
+HTTP_POOL = HttpPool()
+
+
+class _MeteredHttp:
+    """
+    Client HTTP che conta i byte delle risposte ricevute
+    """
+
+    def __init__(self, http):
+        self._http = http
+        self.bytes = 0
+
+    def request(self, *args, **kwargs):
+        response, content = self._http.request(*args, **kwargs)
+        self.bytes += len(content or b"")
+        return response, content
+
+    def __getattr__(self, attribute):
+        return getattr(self._http, attribute)
+
+
+class ApiMetrics:
+    """
+    Misure delle richieste alla API raggruppate per metodo (es. 'drive.permissions.list'):
+    numero di chiamate, latenze, byte ricevuti, errori e limitazioni.
+    Ogni richiesta viene anche inviata alle funzioni registrate con add_sink
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.sinks = []
+
+    def add_sink(self, sink):
+        """
+        Registrare una funzione chiamata con un dizionario per ogni richiesta eseguita
+        ({method, latency, bytes, error, throttled})
+        """
+        self.sinks.append(sink)
+
+    def record(self, method, latency, bytes=0, error=None, throttled=False):
+        """
+        Registrare una richiesta eseguita
+        """
+        with self.lock:
+            metrics = self.methods.setdefault(method, {"calls": 0, "errors": 0, "throttled": 0, "bytes": 0, "latencies": []})
+            metrics["calls"] += 1
+            metrics["bytes"] += bytes
+            metrics["latencies"].append(latency)
+            if error is not None:
+                metrics["errors"] += 1
+            if throttled:
+                metrics["throttled"] += 1
+        event = {"method": method, "latency": latency, "bytes": bytes, "error": error, "throttled": throttled}
+        # Un errore di una funzione registrata non deve far fallire la richiesta misurata
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception as e:
+                print(f"Errore nell'invio delle misure: {e}")
+
+    def reset(self):
+        """
+        Azzerare le misure
+        """
+        with self.lock:
+            self.methods = {}
+
+    def summary(self):
+        """
+        Riassumere le misure per metodo, con i percentili p50/p95/p99 delle latenze in secondi
+        """
+        def percentile(values, fraction):
+            return values[min(len(values) - 1, int(fraction * len(values)))]
+
+        summary = {}
+        with self.lock:
+            for method, metrics in sorted(self.methods.items()):
+                latencies = sorted(metrics["latencies"])
+                summary[method] = {
+                    "calls": metrics["calls"],
+                    "errors": metrics["errors"],
+                    "throttled": metrics["throttled"],
+                    "bytes": metrics["bytes"],
+                    "latency_sum": sum(latencies),
+                    "p50": percentile(latencies, 0.50),
+                    "p95": percentile(latencies, 0.95),
+                    "p99": percentile(latencies, 0.99),
+                }
+        return summary
+
+    def write_json(self, filename):
+        """
+        Esportare il riepilogo delle misure in un file JSON
+        """
+        save_to_file(filename, self.summary())
+
+    def write_prometheus(self, filename):
+        """
+        Esportare il riepilogo delle misure in un file di testo nel formato di Prometheus
+        (utilizzabile con il textfile collector di node_exporter)
+        """
+        lines = []
+        summary = self.summary()
+        for name, key, help in [("calls_total", "calls", "Richieste eseguite"),
+                                ("errors_total", "errors", "Richieste fallite"),
+                                ("throttled_total", "throttled", "Richieste limitate dalla quota"),
+                                ("response_bytes_total", "bytes", "Byte ricevuti")]:
+            lines.append(f"# HELP drive_connect_api_{name} {help}")
+            lines.append(f"# TYPE drive_connect_api_{name} counter")
+            for method, metrics in summary.items():
+                lines.append(f'drive_connect_api_{name}{{method="{method}"}} {metrics[key]}')
+        lines.append("# HELP drive_connect_api_latency_seconds Latenza delle richieste")
+        lines.append("# TYPE drive_connect_api_latency_seconds summary")
+        for method, metrics in summary.items():
+            for quantile in ["p50", "p95", "p99"]:
+                lines.append(f'drive_connect_api_latency_seconds{{method="{method}",quantile="0.{quantile[1:]}"}} {metrics[quantile]}')
+            lines.append(f'drive_connect_api_latency_seconds_sum{{method="{method}"}} {metrics["latency_sum"]}')
+            lines.append(f'drive_connect_api_latency_seconds_count{{method="{method}"}} {metrics["calls"]}')
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_filename, filename)
+
+
+METRICS = ApiMetrics()
+
+
+class LazyService:
+    """
+    Client di una API costruito solo al primo utilizzo, a partire dai documenti
+    di discovery inclusi nella libreria
+    """
+
+    def __init__(self, name, version, credentials):
+        self._name = name
+        self._version = version
+        self._credentials = credentials
+        self._service = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        with self._lock:
+            if self._service is None:
+                self._service = build(self._name, self._version, credentials=self._credentials,
+                                      static_discovery=True, cache_discovery=False)
+        return getattr(self._service, attribute)
 
 
 def clear():
@@ -26,9 +471,11 @@ def clear():
     os.system(command)
 
 
-def authenticate_services():
+def authenticate_services(interactive=True):
     """
-    Autentica i servizi Drive API e Directory API
+    Autentica i servizi Drive API e Directory API.
+    Se interactive è False e non c'è un token valido o rinnovabile non viene aperto il browser
+    per l'accesso ma viene sollevato RuntimeError (per l'uso senza utente, es. da cron)
     """
     creds = None
     # Il file token.json memorizza i token di accesso e di aggiornamento dell'utente
@@ -38,7 +485,14 @@ def authenticate_services():
     # Se non sono disponibili credenziali (valide), consentire all'utente di effettuare l'accesso
     if not creds or not creds.valid:
       if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
+        try:
+          creds.refresh(Request())
+        except RefreshError as e:
+          if interactive:
+            raise
+          raise RuntimeError(f"Impossibile rinnovare il token: {e}. Eseguire main.py senza argomenti per effettuare l'accesso")
+      elif not interactive:
+        raise RuntimeError("Token non trovato o non valido: eseguire main.py senza argomenti per effettuare l'accesso")
       else:
         flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
         creds = flow.run_local_server(port=0)
@@ -46,12 +500,173 @@ def authenticate_services():
       with open("token.json", "w") as token:
         token.write(creds.to_json())
     
-    drive_service = build("drive", "v3", credentials=creds)
-    directory_service = build('admin', 'directory_v1', credentials=creds)
+    HTTP_POOL.credentials = creds
+    _start_token_refresher(creds)
+    drive_service = LazyService("drive", "v3", creds)
+    directory_service = LazyService('admin', 'directory_v1', creds)
     
     return drive_service, directory_service
 
 
+def _start_token_refresher(creds):
+    """
+    Rinnovare il token di accesso in un thread in background, prima che scada,
+    così i thread che eseguono le richieste non devono mai attendere il rinnovo
+    """
+    def refresh():
+        while True:
+            wait = TOKEN_REFRESH_MARGIN
+            if creds.expiry:
+                wait = (creds.expiry - datetime.datetime.utcnow()).total_seconds() - TOKEN_REFRESH_MARGIN
+            time.sleep(max(wait, 30))
+            try:
+                creds.refresh(Request())
+                with open("token.json", "w") as token:
+                    token.write(creds.to_json())
+            except Exception as e:
+                print(f"Errore durante il rinnovo del token: {e}")
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def paginate(service, collection, request, key, pages=False, prefetch=True):
+    """
+    Restituire uno alla volta gli elementi di una richiesta paginata (o le pagine intere, se pages è True),
+    man mano che vengono recuperati.
+    collection è il nome della risorsa della richiesta (es. 'drives') e key la chiave degli elementi nella risposta.
+    Se prefetch è True la pagina successiva viene recuperata in background mentre quella corrente
+    viene consumata
+    """
+    resource = getattr(service, collection)()
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    try:
+        future = executor.submit(execute, request) if executor else None
+        while request is not None:
+            response = future.result() if executor else execute(request)
+            request = resource.list_next(previous_request=request, previous_response=response)
+            if executor and request is not None:
+                future = executor.submit(execute, request)
+            if pages:
+                yield response.get(key, [])
+            else:
+                yield from response.get(key, [])
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _count(key, amount=1):
+    """
+    Incrementare un contatore delle richieste
+    """
+    with _stats_lock:
+        API_STATS[key] += amount
+
+
+def _error_reason(error):
+    """
+    Ottenere il motivo di un errore della API (es. 'userRateLimitExceeded')
+    """
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except Exception:
+        return None
+
+
+def _is_throttled(error):
+    """
+    Verificare se un errore indica il superamento della quota
+    """
+    if not isinstance(error, HttpError):
+        return False
+    return error.resp.status == 429 or (error.resp.status == 403 and _error_reason(error) in RATE_LIMIT_REASONS)
+
+
+def _is_retryable(error):
+    """
+    Verificare se una richiesta fallita con questo errore può essere ritentata
+    """
+    if isinstance(error, HttpError):
+        return _is_throttled(error) or error.resp.status in RETRY_STATUSES
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+def _retry_delay(error, attempt):
+    """
+    Calcolare l'attesa prima del prossimo tentativo, rispettando l'header Retry-After
+    """
+    if isinstance(error, HttpError):
+        try:
+            return float(error.resp.get('retry-after'))
+        except (TypeError, ValueError):
+            pass
+    return min(MAX_BACKOFF, 2 ** attempt) + random.random()
+
+
+def execute(request, cost=1):
+    """
+    Eseguire una richiesta rispettando la quota e ritentandola con backoff esponenziale
+    in caso di limitazione o di errori temporanei.
+    cost è il numero di chiamate contenute nella richiesta (es. per i batch).
+    La richiesta usa un client del pool HTTP_POOL
+    """
+    attempt = 0
+    while True:
+        RATE_LIMITER.acquire(cost)
+        _count("requests", cost)
+        method = getattr(request, 'methodId', None) or "batch"
+        start = time.monotonic()
+        metered_http = None
+        try:
+            with HTTP_POOL.client() as pooled_http:
+                if pooled_http:
+                    metered_http = _MeteredHttp(pooled_http)
+                response = request.execute(http=metered_http)
+            METRICS.record(method, time.monotonic() - start, metered_http.bytes if metered_http else 0)
+            return response
+        except Exception as error:
+            throttled = _is_throttled(error)
+            METRICS.record(method, time.monotonic() - start, metered_http.bytes if metered_http else 0,
+                           str(error), throttled)
+            if throttled:
+                _count("throttled")
+            if attempt >= MAX_RETRIES or not _is_retryable(error):
+                _count("failed")
+                raise
+            delay = _retry_delay(error, attempt)
+            if throttled:
+                RATE_LIMITER.pause(delay)
+            _count("retried")
+            time.sleep(delay)
+            attempt += 1
+
+
+def reset_api_stats():
+    """
+    Azzerare i contatori e le misure delle richieste
+    """
+    with _stats_lock:
+        for key in API_STATS:
+            API_STATS[key] = 0
+    METRICS.reset()
+
+
+def print_api_stats():
+    """
+    Stampare i contatori delle richieste eseguite e le misure per metodo
+    """
+    print(f"Richieste: {API_STATS['requests']} - Limitate: {API_STATS['throttled']} - "
+          f"Ritentate: {API_STATS['retried']} - Fallite: {API_STATS['failed']}")
+    summary = METRICS.summary()
+    if summary:
+        rows = []
+        for method, metrics in summary.items():
+            rows.append([method, metrics['calls'], metrics['errors'], metrics['throttled'], metrics['bytes'],
+                         f"{metrics['p50'] * 1000:.0f}", f"{metrics['p95'] * 1000:.0f}", f"{metrics['p99'] * 1000:.0f}"])
+        print(tabulate(rows, headers=['Metodo', 'Chiamate', 'Errori', 'Limitate', 'Byte', 'p50 ms', 'p95 ms', 'p99 ms'], tablefmt="simple_grid"))
+
+
 def delete_token():
     """
     Elimina il file token.json
@@ -63,46 +678,185 @@ def delete_token():
         print("Token non trovato")
         
 
-def update_data(drive_service):
+def update_data(drive_service, incremental=False, workers=None):
     """
-    Aggiorna i file JSON
+    Aggiorna i dati salvati nel database locale.
+    Se incremental è True vengono aggiornati solo i drive modificati dall'ultimo aggiornamento.
+    L'avanzamento viene salvato periodicamente in CHECKPOINT_FILE: se l'aggiornamento
+    si interrompe, l'esecuzione successiva riprende dai drive non ancora recuperati.
+    Restituisce True se l'aggiornamento è stato completato
     """
-    drives = []
-    permissions = {}
+    checkpoint = load_binary_file(CHECKPOINT_FILE)
+    if incremental and not checkpoint and get_metadata("start_page_token"):
+        return sync_data(drive_service, workers)
+    if checkpoint:
+        print(f"Ripresa dell'aggiornamento interrotto: "
+              f"{len(checkpoint['completed'])}/{len(checkpoint['drives'])} drive già recuperati")
+    else:
+        # Il token viene ottenuto prima del recupero, così le modifiche successive non vanno perse
+        start_page_token = get_start_page_token(drive_service)
+        print("Recupero drive condivisi...")
+        drives = _fetch_all_drives(drive_service, True)
+        checkpoint = {"start_page_token": start_page_token, "drives": drives, "completed": {}}
+        save_binary_file(CHECKPOINT_FILE, checkpoint)
+    print()
+
+    last_save = time.monotonic()
+
+    def on_result(drive_id, permissions):
+        nonlocal last_save
+        checkpoint['completed'][drive_id] = [Permission.from_dict(permission) for permission in permissions]
+        if time.monotonic() - last_save > CHECKPOINT_INTERVAL:
+            save_binary_file(CHECKPOINT_FILE, checkpoint)
+            last_save = time.monotonic()
+
+    remaining = [drive['id'] for drive in checkpoint['drives'] if drive['id'] not in checkpoint['completed']]
     try:
-        if os.path.exists("shared_drives.json"):
-            drives = get_all_drives(drive_service, True)
-            os.remove("shared_drives.json")
-        get_all_drives(drive_service, True)
-        print()
-        if os.path.exists("permissions.json"):
-            permissions = get_all_drives_permissions(drive_service)
-            os.remove("permissions.json")
-        get_all_drives_permissions(drive_service)
-    except KeyboardInterrupt:
-        print("\nInterruzione rilevata. Ripristino dati...")
-        save_to_file("shared_drives.json", drives)
-        save_to_file("permissions.json", permissions)
+        print(f"Recupero permessi...")
+        fetch_drives_permissions(drive_service, remaining, workers, on_result)
+    except BaseException as e:
+        save_binary_file(CHECKPOINT_FILE, checkpoint)
+        if isinstance(e, KeyboardInterrupt):
+            print("\nInterruzione rilevata. Avanzamento salvato: ripetere l'aggiornamento per riprendere.")
+            return False
+        raise
+    save_binary_file(CHECKPOINT_FILE, checkpoint)
+
+    missing = len(checkpoint['drives']) - len(checkpoint['completed'])
+    if missing:
+        # I dati salvati vengono sostituiti solo quando tutti i drive sono stati recuperati
+        print(f"\nPermessi non recuperati per {missing} drive. Ripetere l'aggiornamento per riprendere.")
+        return False
+    all_permissions = {}
+    for drive in checkpoint['drives']:
+        all_permissions[drive['id']] = {
+            "name": drive['name'],
+            "permissions": [permission.to_dict() for permission in checkpoint['completed'][drive['id']]]
+        }
+    with _transaction():
+        store_drives(checkpoint['drives'])
+        store_permissions(all_permissions)
+        set_metadata("start_page_token", checkpoint['start_page_token'])
+        take_snapshot()
+    os.remove(CHECKPOINT_FILE)
+    return True
+
+
+def get_start_page_token(drive_service):
+    """
+    Ottenere il token da cui iniziare a leggere le modifiche successive
+    """
+    response = execute(drive_service.changes().getStartPageToken(supportsAllDrives=True))
+    return response.get('startPageToken')
+
+
+def get_changed_drives(drive_service, start_page_token):
+    """
+    Leggere le modifiche avvenute dal token indicato.
+    Restituisce gli id dei drive modificati, gli id dei drive rimossi e il nuovo token
+    """
+    changed = set()
+    removed = set()
+    new_start_page_token = start_page_token
+    request = drive_service.changes().list(
+        pageToken=start_page_token,
+        includeItemsFromAllDrives=True,
+        supportsAllDrives=True,
+        includeRemoved=True,
+        pageSize=1000,
+        fields="nextPageToken,newStartPageToken,changes(changeType,removed,driveId,fileId,file(driveId))"
+    )
+    while request is not None:
+        response = execute(request)
+        for change in response.get('changes', []):
+            if change.get('changeType') == "drive":
+                if change.get('removed'):
+                    removed.add(change.get('driveId'))
+                else:
+                    changed.add(change.get('driveId'))
+            # La cartella principale di un drive condiviso ha lo stesso id del drive
+            elif change.get('fileId') and change.get('fileId') == change.get('file', {}).get('driveId'):
+                changed.add(change.get('fileId'))
+        new_start_page_token = response.get('newStartPageToken', new_start_page_token)
+        request = drive_service.changes().list_next(previous_request=request, previous_response=response)
+    return changed, removed - changed, new_start_page_token
+
+
+def sync_data(drive_service, workers=None):
+    """
+    Aggiornare i dati in modo incrementale, recuperando i permessi dei soli drive
+    nuovi o modificati dall'ultimo aggiornamento.
+    changes().list non supporta useDomainAdminAccess e non riporta le modifiche dei drive
+    di cui l'amministratore non è membro: l'elenco dei drive viene riletto con e senza
+    accesso da amministratore (una richiesta ogni 100 drive) e i permessi dei drive
+    di cui l'amministratore non è membro vengono sempre recuperati di nuovo.
+    Restituisce True se i permessi di tutti i drive modificati sono stati recuperati
+    """
+    start_page_token = get_metadata("start_page_token")
+    if not start_page_token or not get_metadata("permissions_loaded"):
+        return update_data(drive_service, workers=workers)
+
+    print("Recupero modifiche...")
+    changed, removed, start_page_token = get_changed_drives(drive_service, start_page_token)
+    print("Recupero drive condivisi...")
+    drives = _fetch_all_drives(drive_service, True)
+    drive_ids = {drive['id'] for drive in drives}
+    unwatched = drive_ids - {drive['id'] for drive in _fetch_all_drives(drive_service)}
+    stored_ids = set(get_stored_drive_ids())
+    changed |= drive_ids - stored_ids
+    changed |= unwatched
+    removed |= stored_ids - drive_ids
+    changed &= drive_ids
+
+    print(f"Drive modificati o di cui non sei membro: {len(changed)} ({len(unwatched)} senza modifiche tracciabili)"
+          f" - Drive rimossi: {len(removed)}")
+    results = fetch_drives_permissions(drive_service, sorted(changed), workers) if changed else {}
+    drive_names = {drive['id']: drive['name'] for drive in drives}
+    # I drive nuovi di cui non sono stati recuperati i permessi non vengono salvati,
+    # così al prossimo aggiornamento risultano ancora nuovi e vengono ritentati
+    drives = [drive for drive in drives if drive['id'] in stored_ids or drive['id'] in results]
+    with _transaction():
+        store_drives(drives)
+        store_permissions({drive_id: {"name": drive_names[drive_id], "permissions": permissions}
+                           for drive_id, permissions in results.items()}, replace=False)
+        # Se alcuni drive non sono stati recuperati il token non avanza, così verranno ritentati
+        if len(results) == len(changed):
+            set_metadata("start_page_token", start_page_token)
+        if results or removed:
+            take_snapshot()
+    return len(results) == len(changed)
         
         
 def delete_data():
     """
-    Elimina i file JSON
+    Elimina il database locale e gli eventuali file JSON delle versioni precedenti
     """
-    if os.path.exists("shared_drives.json"):
-        os.remove("shared_drives.json")
-        print("shared_drives.json eliminato")
-    if os.path.exists("permissions.json"):
-        os.remove("permissions.json")
-        print("permissions.json eliminato")
+    global _db
+    _invalidate_models()
+    with _db_lock:
+        if _db is not None:
+            _db.close()
+            _db = None
+        if os.path.exists(DATABASE_FILE):
+            os.remove(DATABASE_FILE)
+            print(f"{DATABASE_FILE} eliminato")
+    for filename in LEGACY_FILES + [CHECKPOINT_FILE]:
+        if os.path.exists(filename):
+            os.remove(filename)
+            print(f"{filename} eliminato")
         
 
-def save_to_file(filename, data):
+def save_to_file(filename, data, indent=4):
     """
-    Salva dati in un file JSON
+    Salva dati in un file JSON.
+    Il file viene scritto in un file temporaneo e poi rinominato, così non resta mai incompleto
     """
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=4)
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'w') as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
 
 
 def load_from_file(filename):
@@ -114,33 +868,526 @@ def load_from_file(filename):
             return json.load(f)
     return None
 
-  
-def get_all_drives(drive_service, useDomainAdminAccess=False):
+
+def save_binary_file(filename, data):
     """
-    Ottenere l'elenco di tutti i drive condivisi
+    Salvare dati in un file binario (pickle), più compatto e veloce da leggere e scrivere del JSON.
+    Come in save_to_file il file non resta mai incompleto
+    """
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, 'wb') as f:
+        pickle.dump(data, f, protocol=5)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filename, filename)
+
+
+def load_binary_file(filename):
+    """
+    Caricare dati da un file binario salvato con save_binary_file, se esiste ed è leggibile
+    """
+    if os.path.exists(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ValueError) as e:
+            print(f"Impossibile leggere {filename}: {e}")
+    return None
+
+
+def _invalidate_models(*keys):
+    """
+    Scartare i dati letti dal database indicati da keys ('permissions', 'users') dopo una loro modifica.
+    Senza keys vengono scartati tutti, insieme all'indice dei nomi dei drive (dopo store_drives o delete_data)
+    """
+    global _drive_index
+    with _db_lock:
+        if keys:
+            for key in keys:
+                _models.pop(key, None)
+            return
+        _models.clear()
+        _drive_index = None
+
+
+def _load_models(key, load):
+    """
+    Ottenere dalla cache i dati salvati indicati da key, leggendoli con load se necessario
+    """
+    with _db_lock:
+        if key not in _models:
+            _models[key] = load()
+        return _models[key]
+
+
+def _drive_models():
+    return _load_models("drives", lambda: tuple(Drive(drive_id, name) for drive_id, name
+                                                in _query("SELECT id, name FROM drives ORDER BY rowid")))
+
+
+def _permission_models():
+    def load():
+        permissions = {drive.id: [] for drive in _drive_models()}
+        for row in _query("SELECT drive_id, id, email, domain, type, role FROM permissions ORDER BY drive_id, rowid"):
+            if row[0] in permissions:
+                permissions[row[0]].append(Permission.from_row(row[1:]))
+        return {drive_id: tuple(drive_permissions) for drive_id, drive_permissions in permissions.items()}
+    return _load_models("permissions", load)
+
+
+def _user_models():
+    return _load_models("users", lambda: tuple(User.from_dict(json.loads(data))
+                                               for data, in _query("SELECT data FROM users ORDER BY rowid")))
+
+
+def _database():
+    """
+    Ottenere la connessione al database locale, creandolo e importando i vecchi file JSON se necessario
+    """
+    global _db
+    with _db_lock:
+        if _db is None:
+            new = not os.path.exists(DATABASE_FILE)
+            _db = sqlite3.connect(DATABASE_FILE, check_same_thread=False)
+            _db.executescript(SCHEMA)
+            if new:
+                import_json_files()
+        return _db
+
+
+@contextmanager
+def _transaction():
+    """
+    Eseguire un blocco di operazioni sul database in un'unica transazione.
+    Le transazioni annidate fanno parte di quella più esterna
+    """
+    global _transaction_depth
+    with _db_lock:
+        db = _database()
+        _transaction_depth += 1
+        try:
+            yield db
+            if _transaction_depth == 1:
+                db.commit()
+        except BaseException:
+            if _transaction_depth == 1:
+                db.rollback()
+            raise
+        finally:
+            _transaction_depth -= 1
+
+
+def _query(sql, parameters=()):
+    """
+    Eseguire una query di lettura sul database locale
+    """
+    with _db_lock:
+        return _database().execute(sql, parameters).fetchall()
+
+
+def get_metadata(key):
+    """
+    Leggere un valore dalla tabella metadata
+    """
+    rows = _query("SELECT value FROM metadata WHERE key = ?", (key,))
+    return rows[0][0] if rows else None
+
+
+def set_metadata(key, value):
+    """
+    Scrivere un valore nella tabella metadata
+    """
+    with _transaction() as db:
+        db.execute("INSERT INTO metadata (key, value) VALUES (?, ?) "
+                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+
+def store_drives(drives):
+    """
+    Salvare l'elenco completo dei drive condivisi, eliminando quelli non più presenti
+    e i relativi permessi
+    """
+    with _transaction() as db:
+        db.execute("DELETE FROM drives")
+        db.executemany("INSERT INTO drives (id, name, data) VALUES (?, ?, ?)",
+                       [(drive['id'], drive.get('name'), json.dumps(drive)) for drive in drives])
+        db.execute("DELETE FROM permissions WHERE drive_id NOT IN (SELECT id FROM drives)")
+        set_metadata("drives_loaded", "1")
+    _invalidate_models()
+
+
+def load_stored_drives():
+    """
+    Leggere i drive condivisi salvati, nell'ordine in cui sono stati recuperati
+    """
+    if not get_metadata("drives_loaded"):
+        return None
+    return [drive.to_dict() for drive in _drive_models()]
+
+
+def get_stored_drive_ids():
+    """
+    Leggere gli id dei drive condivisi salvati
+    """
+    return [row[0] for row in _query("SELECT id FROM drives ORDER BY rowid")]
+
+
+def _permission_row(drive_id, permission):
+    return (drive_id, permission.get('id'), permission.get('emailAddress'), permission.get('domain'),
+            permission.get('type'), permission.get('role'))
+
+
+def _permission_from_row(row):
+    keys = ["id", "emailAddress", "domain", "type", "role"]
+    return {key: value for key, value in zip(keys, row) if value is not None}
+
+
+def store_permissions(all_permissions, replace=True):
+    """
+    Salvare i permessi dei drive ({drive_id: {name, permissions}}).
+    Se replace è True i permessi salvati in precedenza vengono eliminati,
+    altrimenti vengono sostituiti solo quelli dei drive indicati
+    """
+    with _transaction() as db:
+        if replace:
+            db.execute("DELETE FROM permissions")
+        else:
+            db.executemany("DELETE FROM permissions WHERE drive_id = ?", [(drive_id,) for drive_id in all_permissions])
+        db.executemany("INSERT OR REPLACE INTO permissions (drive_id, id, email, domain, type, role) VALUES (?, ?, ?, ?, ?, ?)",
+                       [_permission_row(drive_id, permission)
+                        for drive_id, drive in all_permissions.items()
+                        for permission in drive.get('permissions', [])])
+        if replace:
+            set_metadata("permissions_loaded", "1")
+    _invalidate_models("permissions")
+
+
+def load_stored_permissions():
+    """
+    Leggere i permessi salvati di tutti i drive, nella stessa struttura di get_all_drives_permissions
+    """
+    if not get_metadata("permissions_loaded"):
+        return None
+    names = {drive.id: drive.name for drive in _drive_models()}
+    return {drive_id: {"name": names.get(drive_id), "permissions": [permission.to_dict() for permission in permissions]}
+            for drive_id, permissions in _permission_models().items()}
+
+
+def get_stored_drive_permissions(drive_id):
+    """
+    Leggere i permessi salvati di un drive condiviso, o None se il drive non è presente
+    """
+    if not get_metadata("permissions_loaded"):
+        return None
+    if "permissions" not in _models:
+        # Per un solo drive è più veloce interrogare il database che caricare i permessi di tutti i drive
+        if not _query("SELECT 1 FROM drives WHERE id = ?", (drive_id,)):
+            return None
+        rows = _query("SELECT id, email, domain, type, role FROM permissions WHERE drive_id = ? ORDER BY rowid", (drive_id,))
+        return [_permission_from_row(row) for row in rows]
+    permissions = _permission_models().get(drive_id)
+    if permissions is None:
+        return None
+    return [permission.to_dict() for permission in permissions]
+
+
+def update_stored_permissions(results):
+    """
+    Allineare i permessi salvati alle operazioni sui permessi eseguite con successo
+    """
+    if not get_metadata("permissions_loaded"):
+        return
+    with _transaction() as db:
+        for result in results:
+            if not result.get('success'):
+                continue
+            if result['action'] == "create":
+                permission = {"id": result.get('permission_id'), "type": result.get('type'), "role": result.get('role')}
+                permission["domain" if result.get('type') == "domain" else "emailAddress"] = result.get('email')
+                db.execute("INSERT OR REPLACE INTO permissions (drive_id, id, email, domain, type, role) VALUES (?, ?, ?, ?, ?, ?)",
+                           _permission_row(result['drive_id'], permission))
+            elif result['action'] == "update":
+                db.execute("UPDATE permissions SET role = ? WHERE drive_id = ? AND id = ?",
+                           (result.get('role'), result['drive_id'], result.get('permission_id')))
+            elif result['action'] == "delete":
+                db.execute("DELETE FROM permissions WHERE drive_id = ? AND id = ?",
+                           (result['drive_id'], result.get('permission_id')))
+    _invalidate_models("permissions")
+
+
+def store_users(users):
+    """
+    Salvare tutti gli utenti del dominio con le loro email (primarie e alias)
+    """
+    with _transaction() as db:
+        db.execute("DELETE FROM users")
+        db.execute("DELETE FROM user_emails")
+        db.executemany("INSERT OR REPLACE INTO users (id, primary_email, data) VALUES (?, ?, ?)",
+                       [(user.get('id'), user.get('primaryEmail'), json.dumps(user)) for user in users])
+        db.executemany("INSERT OR REPLACE INTO user_emails (email, user_id) VALUES (?, ?)",
+                       [(email, user.get('id'))
+                        for user in users
+                        for email in [user.get('primaryEmail')] + user.get('aliases', []) if email])
+        set_metadata("users_updated", str(time.time()))
+    _invalidate_models("users")
+
+
+def import_json_files():
+    """
+    Importare nel database i file JSON usati dalle versioni precedenti ed eliminarli
+    """
+    drives = load_from_file("shared_drives.json")
+    permissions = load_from_file("permissions.json")
+    users = load_from_file("users.json")
+    sync_state = load_from_file("sync_state.json")
+    with _transaction():
+        if drives:
+            store_drives(drives)
+        if permissions:
+            store_permissions(permissions)
+        if users:
+            store_users(users.get('users', []))
+            set_metadata("users_updated", str(users.get('updated', 0)))
+        if sync_state and drives and permissions:
+            set_metadata("start_page_token", sync_state.get('start_page_token'))
+    for filename in LEGACY_FILES:
+        if os.path.exists(filename):
+            os.remove(filename)
+            print(f"{filename} importato in {DATABASE_FILE}")
+
+
+def take_snapshot(note=None):
+    """
+    Salvare una versione dei permessi attuali di tutti i drive.
+    I permessi di ogni drive vengono salvati compressi e identificati dal loro hash,
+    così i drive non modificati non occupano altro spazio nelle versioni successive.
+    Restituisce l'id della versione, o None se i permessi non sono ancora stati recuperati
+    """
+    if not get_metadata("permissions_loaded"):
+        return None
+    with _transaction() as db:
+        rows = db.execute("SELECT d.id, p.id, p.email, p.domain, p.type, p.role FROM drives d "
+                          "LEFT JOIN permissions p ON p.drive_id = d.id ORDER BY d.id, p.id").fetchall()
+        created = datetime.datetime.now().isoformat(timespec="seconds")
+        snapshot_id = db.execute("INSERT INTO snapshots (created, note) VALUES (?, ?)", (created, note)).lastrowid
+        permission_sets = {}
+        snapshot_drives = []
+        for drive_id, drive_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            data = json.dumps([row[1:] for row in drive_rows if row[1] is not None], separators=(",", ":")).encode()
+            digest = hashlib.sha256(data).hexdigest()
+            permission_sets[digest] = data
+            snapshot_drives.append((snapshot_id, drive_id, digest))
+        db.executemany("INSERT OR IGNORE INTO permission_sets (hash, data) VALUES (?, ?)",
+                       [(digest, zlib.compress(data)) for digest, data in permission_sets.items()])
+        db.executemany("INSERT INTO snapshot_drives (snapshot_id, drive_id, hash) VALUES (?, ?, ?)", snapshot_drives)
+    return snapshot_id
+
+
+def list_snapshots():
+    """
+    Ottenere l'elenco delle versioni dei permessi salvate, dalla meno recente
+    """
+    rows = _query("SELECT s.id, s.created, s.note, COUNT(sd.drive_id) FROM snapshots s "
+                  "LEFT JOIN snapshot_drives sd ON sd.snapshot_id = s.id GROUP BY s.id ORDER BY s.id")
+    return [{"id": snapshot_id, "created": created, "note": note, "drives": drives}
+            for snapshot_id, created, note, drives in rows]
+
+
+def _load_permission_set(digest):
+    """
+    Leggere i permessi di un drive salvati in una versione, indicizzati per destinatario
+    """
+    if digest is None:
+        return {}
+    data = _query("SELECT data FROM permission_sets WHERE hash = ?", (digest,))[0][0]
+    permissions = {}
+    for row in json.loads(zlib.decompress(data)):
+        permission = _permission_from_row(row)
+        permissions[_permission_key(permission.get('type'), permission.get('emailAddress') or permission.get('domain'))] = permission
+    return permissions
+
+
+def diff_snapshots(old_id=None, new_id=None):
+    """
+    Restituire una alla volta le differenze tra i permessi di due versioni
+    (in mancanza degli id, tra le ultime due): permessi aggiunti, rimossi o con un ruolo diverso.
+    Vengono letti e confrontati solo i permessi dei drive il cui hash è cambiato
+    """
+    snapshot_ids = [snapshot['id'] for snapshot in list_snapshots()]
+    if new_id is None:
+        new_id = snapshot_ids[-1] if snapshot_ids else None
+    if old_id is None:
+        previous = [snapshot_id for snapshot_id in snapshot_ids if snapshot_id < (new_id or 0)]
+        old_id = previous[-1] if previous else None
+    if old_id is None:
+        raise ValueError("Servono almeno due versioni dei permessi per il confronto")
+    for snapshot_id in [old_id, new_id]:
+        if snapshot_id not in snapshot_ids:
+            raise ValueError(f"Versione dei permessi non trovata: {snapshot_id}")
+
+    changed = _query("SELECT n.drive_id, d.name, o.hash, n.hash FROM snapshot_drives n "
+                     "LEFT JOIN snapshot_drives o ON o.snapshot_id = ? AND o.drive_id = n.drive_id "
+                     "LEFT JOIN drives d ON d.id = n.drive_id "
+                     "WHERE n.snapshot_id = ? AND (o.hash IS NULL OR o.hash != n.hash)", (old_id, new_id))
+    removed = _query("SELECT o.drive_id, d.name, o.hash, NULL FROM snapshot_drives o "
+                     "LEFT JOIN snapshot_drives n ON n.snapshot_id = ? AND n.drive_id = o.drive_id "
+                     "LEFT JOIN drives d ON d.id = o.drive_id "
+                     "WHERE o.snapshot_id = ? AND n.drive_id IS NULL", (new_id, old_id))
+    for drive_id, drive_name, old_hash, new_hash in changed + removed:
+        old_permissions = _load_permission_set(old_hash)
+        new_permissions = _load_permission_set(new_hash)
+        for key, permission in new_permissions.items():
+            previous = old_permissions.get(key)
+            if previous is None:
+                change = "added"
+            elif previous.get('role') != permission.get('role'):
+                change = "role_changed"
+            else:
+                continue
+            yield {"drive_id": drive_id, "drive_name": drive_name, "change": change, "type": key[0], "email": key[1],
+                   "role": permission.get('role'), "previous_role": previous.get('role') if previous else None}
+        for key, permission in old_permissions.items():
+            if key not in new_permissions:
+                yield {"drive_id": drive_id, "drive_name": drive_name, "change": "removed", "type": key[0], "email": key[1],
+                       "role": None, "previous_role": permission.get('role')}
+
+
+def iter_all_drives(drive_service, useDomainAdminAccess=False, pages=False):
+    """
+    Restituire uno alla volta i drive condivisi (o le pagine, se pages è True), man mano che vengono recuperati
     """
-    existing_shared_drives = load_from_file("shared_drives.json")
-    if existing_shared_drives:
-        return existing_shared_drives
-    all_shared_drives = []
-    
-    print(f"Recupero drive condivisi...")
     request = drive_service.drives().list(
       useDomainAdminAccess=useDomainAdminAccess,
       pageSize=100
     )
-    while request is not None:
-        response = request.execute()
-        all_shared_drives.extend(response.get('drives', []))
-        request = drive_service.drives().list_next(previous_request=request, previous_response=response)
-        
-    save_to_file("shared_drives.json", all_shared_drives)
-    return all_shared_drives
+    return paginate(drive_service, "drives", request, "drives", pages=pages)
+
+
+def _fetch_all_drives(drive_service, useDomainAdminAccess=False):
+    """
+    Recuperare l'elenco di tutti i drive condivisi dalla Drive API
+    """
+    return list(iter_all_drives(drive_service, useDomainAdminAccess))
+
+
+def get_drive_models(drive_service, useDomainAdminAccess=False):
+    """
+    Ottenere i drive condivisi salvati come oggetti Drive (da non modificare), senza copiarli in dizionari.
+    Se non ci sono drive salvati vengono recuperati dalla Drive API e salvati
+    """
+    if not get_metadata("drives_loaded") or not _drive_models():
+        print(f"Recupero drive condivisi...")
+        store_drives(_fetch_all_drives(drive_service, useDomainAdminAccess))
+    return _drive_models()
+
+
+def get_all_drives(drive_service, useDomainAdminAccess=False):
+    """
+    Ottenere l'elenco di tutti i drive condivisi
+    """
+    return [drive.to_dict() for drive in get_drive_models(drive_service, useDomainAdminAccess)]
       
       
-def get_drive_permissions(drive_service, drive_id):
+class DriveIndex:
     """
-    Ottenere i permessi di un drive condiviso
+    Indice dei nomi dei drive condivisi per suggerirli durante la digitazione.
+    Ogni trigramma dei nomi punta ai drive che lo contengono; le parole dei nomi
+    sono ordinate per cercare i testi più corti di tre caratteri come prefissi di parola.
+    Ogni drive ha un'etichetta univoca (il nome, seguito dall'id se il nome è ripetuto)
+    da cui si risale direttamente al drive
+    """
+
+    def __init__(self, drives):
+        self.drives = [drive for drive in drives if drive.id]
+        self.names = [(drive.name or "").lower() for drive in self.drives]
+        self.trigrams = {}
+        self.words = []
+        self.labels = []
+        self.by_label = {}
+        self.by_id = {}
+        repeated = Counter(self.names)
+        for position, (drive, name) in enumerate(zip(self.drives, self.names)):
+            for trigram in {name[i:i + 3] for i in range(len(name) - 2)}:
+                self.trigrams.setdefault(trigram, []).append(position)
+            self.words.extend((word, position) for word in set(name.split()))
+            label = drive.name or drive.id
+            if repeated[name] > 1 or not name:
+                label = f"{label} [{drive.id}]"
+            self.labels.append(label)
+            self.by_label[label.lower()] = drive
+            self.by_id[drive.id] = drive
+        self.words.sort()
+        # Posizioni dei drive ordinate dal nome più corto, e posto di ogni drive in questo ordine
+        self.order = sorted(range(len(self.drives)), key=lambda position: (len(self.names[position]), self.names[position]))
+        self.ranks = [0] * len(self.order)
+        for rank, position in enumerate(self.order):
+            self.ranks[position] = rank
+
+    def _candidates(self, text):
+        if len(text) < 3:
+            start = bisect.bisect_left(self.words, (text,))
+            candidates = set()
+            for word, position in self.words[start:]:
+                if not word.startswith(text):
+                    break
+                candidates.add(position)
+            return candidates
+        postings = sorted((self.trigrams.get(text[i:i + 3], ()) for i in range(len(text) - 2)), key=len)
+        candidates = set(postings[0])
+        for positions in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(positions)
+        return candidates
+
+    def search(self, text, limit=DRIVE_SUGGESTIONS):
+        """
+        Ottenere i drive il cui nome contiene il testo indicato, come coppie (etichetta, Drive).
+        Vengono restituiti prima i nomi uguali al testo, poi quelli che iniziano con il testo,
+        poi quelli con una parola che inizia con il testo e infine gli altri, i più corti per primi
+        """
+        text = text.strip().lower()
+        if not text:
+            ranks = range(min(limit, len(self.order)))
+        else:
+            tiers = ([], [], [], [])
+            for position in self._candidates(text):
+                name = self.names[position]
+                if name.startswith(text):
+                    tiers[0 if name == text else 1].append(self.ranks[position])
+                elif " " + text in name:
+                    tiers[2].append(self.ranks[position])
+                elif text in name:
+                    tiers[3].append(self.ranks[position])
+            ranks = []
+            for tier in tiers:
+                ranks.extend(heapq.nsmallest(limit - len(ranks), tier))
+                if len(ranks) >= limit:
+                    break
+        return [(self.labels[self.order[rank]], self.drives[self.order[rank]]) for rank in ranks]
+
+    def resolve(self, text):
+        """
+        Ottenere il drive corrispondente a un'etichetta, a un nome non ripetuto o a un id
+        """
+        text = text.strip()
+        return self.by_label.get(text.lower()) or self.by_id.get(text)
+
+
+def get_drive_index(drive_service):
+    """
+    Ottenere l'indice dei nomi dei drive condivisi, costruendolo solo quando cambia l'elenco dei drive
+    """
+    global _drive_index
+    if _drive_index is None:
+        _drive_index = DriveIndex(get_drive_models(drive_service, True))
+    return _drive_index
+
+
+def get_drive_permissions(drive_service, drive_id, raise_errors=False):
+    """
+    Ottenere i permessi di un drive condiviso.
+    Se raise_errors è True gli errori vengono propagati invece di essere solo stampati
     """
     permissions = []
     try:
@@ -148,42 +1395,75 @@ def get_drive_permissions(drive_service, drive_id):
             fileId=drive_id,
             supportsTeamDrives=True,
             useDomainAdminAccess=True,
-            fields="permissions(id,emailAddress,type,kind,role),nextPageToken"
+            fields="permissions(id,emailAddress,domain,type,kind,role),nextPageToken"
         )
-        while request is not None:
-            response = request.execute()
-            permissions.extend(response.get('permissions', []))
-            request = drive_service.permissions().list_next(previous_request=request, previous_response=response)
+        # Il recupero è già parallelo tra i drive: le pagine di un singolo drive vengono lette in sequenza
+        permissions.extend(paginate(drive_service, "permissions", request, "permissions", prefetch=False))
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Errore durante il recupero dei permessi per il drive {drive_id}: {e}")
     return permissions
   
 
-def get_all_drives_permissions(drive_service):
+def fetch_drives_permissions(drive_service, drive_ids, workers=None, on_result=None):
     """
-    Ottenere i permessi di tutti i drive condivisi
+    Ottenere i permessi di più drive condivisi usando più worker in parallelo.
+    Restituisce un dizionario {drive_id: permessi}, da cui sono esclusi i drive per cui
+    il recupero è fallito per errori temporanei anche dopo i nuovi tentativi.
+    Se specificato, on_result(drive_id, permessi) viene chiamato per ogni drive recuperato
     """
-    existing_permissions = load_from_file("permissions.json")
+    def fetch(drive_id):
+        return get_drive_permissions(drive_service, drive_id, raise_errors=True)
+
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, workers or WORKERS))
+    try:
+        with tqdm(total=len(drive_ids)) as progress:
+            futures = {executor.submit(fetch, drive_id): drive_id for drive_id in drive_ids}
+            for future in as_completed(futures):
+                drive_id = futures[future]
+                progress.update()
+                try:
+                    permissions = future.result()
+                except Exception as e:
+                    print(f"Errore durante il recupero dei permessi per il drive {drive_id}: {e}")
+                    if _is_retryable(e):
+                        continue
+                    permissions = []
+                results[drive_id] = permissions
+                if on_result:
+                    on_result(drive_id, permissions)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def get_all_drives_permissions(drive_service, workers=None):
+    """
+    Ottenere i permessi di tutti i drive condivisi, usando più worker in parallelo
+    """
+    existing_permissions = load_stored_permissions()
     if existing_permissions:
         return existing_permissions
-    all_permissions = {}
-    shared_drives = get_all_drives(drive_service, True)
-    
-    print(f"Recupero permessi...")
-    for drive in tqdm(shared_drives):
-        permissions = get_drive_permissions(drive_service, drive['id'])
-        all_permissions[drive['id']] = {
-            "name": drive['name'],
-            "permissions": permissions
-        }
-        
-    save_to_file("permissions.json", all_permissions)
-    return all_permissions
+    update_data(drive_service, workers=workers)
+    return load_stored_permissions() or {}
+
+
+def get_drive_permissions_cached(drive_service, drive_id):
+    """
+    Ottenere i permessi di un drive condiviso dal database locale,
+    recuperandoli dalla Drive API se il drive non è presente
+    """
+    permissions = get_stored_drive_permissions(drive_id)
+    if permissions is None:
+        permissions = get_drive_permissions(drive_service, drive_id)
+    return permissions
       
 
-def create_drive_permission(drive_service, drive_id, email, type, role):
+def _permission_body(email, type, role):
     """
-    Aggiungere un nuovo permesso a un drive condiviso
+    Costruire il corpo di un nuovo permesso
     """
     permission_body = {
         "type": type,   # 'user', 'group', o 'domain'
@@ -193,103 +1473,866 @@ def create_drive_permission(drive_service, drive_id, email, type, role):
     # Aggiungere l'email solo per permessi di tipo 'user' o 'group'
     if type in ["user", "group"]:
         permission_body["emailAddress"] = email
+    # Per i permessi di tipo 'domain' l'email indica il dominio
+    elif type == "domain":
+        permission_body["domain"] = email
+    return permission_body
 
-    try:
-        drive_service.permissions().create(
-            fileId=drive_id,
-            body=permission_body,
+
+def _permission_request(drive_service, operation):
+    """
+    Costruire la richiesta (non eseguita) corrispondente a un'operazione sui permessi
+    """
+    action = operation.get("action")
+    if action == "create":
+        return drive_service.permissions().create(
+            fileId=operation["drive_id"],
+            body=_permission_body(operation.get("email"), operation.get("type"), operation.get("role")),
             supportsTeamDrives=True,
             useDomainAdminAccess=True,
             sendNotificationEmail=False,
             fields="id"
-        ).execute()
-        return True
+        )
+    if action == "update":
+        return drive_service.permissions().update(
+            fileId=operation["drive_id"],
+            permissionId=operation["permission_id"],
+            body={"role": operation.get("role")},
+            supportsTeamDrives=True,
+            useDomainAdminAccess=True,
+            fields="id"
+        )
+    if action == "delete":
+        return drive_service.permissions().delete(
+            fileId=operation["drive_id"],
+            permissionId=operation["permission_id"],
+            supportsTeamDrives=True,
+            useDomainAdminAccess=True
+        )
+    raise ValueError(f"Operazione non valida: {action}")
+
+
+def _execute_permission_operation(drive_service, operation):
+    """
+    Eseguire una singola operazione sui permessi e aggiornare i permessi salvati
+    """
+    try:
+        response = execute(_permission_request(drive_service, operation))
     except Exception as e:
+        print(f"Errore durante l'operazione sul permesso: {e}")
         return False
+    result = dict(operation, success=True, error=None)
+    if operation["action"] == "create":
+        result["permission_id"] = (response or {}).get("id")
+    update_stored_permissions([result])
+    return True
+
+
+def create_drive_permission(drive_service, drive_id, email, type, role):
+    """
+    Aggiungere un nuovo permesso a un drive condiviso
+    """
+    operation = {"action": "create", "drive_id": drive_id, "email": email, "type": type, "role": role}
+    return _execute_permission_operation(drive_service, operation)
   
   
 def delete_drive_permission(drive_service, drive_id, permission_id):
     """
     Rimuovere un permesso da un drive condiviso
     """
-    try:
-        drive_service.permissions().delete(
-            fileId=drive_id,
-            permissionId=permission_id,
-            supportsTeamDrives=True,
-            useDomainAdminAccess=True
-        ).execute()
-        return True
-    except Exception as e:
-        return False
+    operation = {"action": "delete", "drive_id": drive_id, "permission_id": permission_id}
+    return _execute_permission_operation(drive_service, operation)
+
+
+def update_drive_permission(drive_service, drive_id, permission_id, role):
+    """
+    Modificare il ruolo di un permesso esistente di un drive condiviso
+    """
+    operation = {"action": "update", "drive_id": drive_id, "permission_id": permission_id, "role": role}
+    return _execute_permission_operation(drive_service, operation)
+
+
+def execute_permission_batch(drive_service, operations, show_progress=True):
+    """
+    Eseguire in batch una lista di operazioni sui permessi.
+    Ogni operazione è un dizionario con le chiavi "action" ('create', 'update' o 'delete') e "drive_id",
+    più "email", "type" e "role" per la creazione, "permission_id" e "role" per la modifica
+    oppure "permission_id" per la rimozione.
+    Le operazioni limitate dalla quota vengono ritentate in un batch successivo.
+    Restituisce un risultato per ogni operazione, nello stesso ordine, con le chiavi
+    "success" ed "error" e con "permission_id" valorizzato per i permessi creati;
+    per le operazioni fallite "status" è il codice HTTP (se presente) e "retryable"
+    indica se l'errore è temporaneo
+    """
+    results = [None] * len(operations)
+    pending = list(range(len(operations)))
+    attempt = 0
+    progress = tqdm(total=len(operations), disable=not show_progress)
+    methods = {}
+    batch_start = None
+
+    def callback(request_id, response, exception):
+        index = int(request_id)
+        # Ogni richiesta del batch viene misurata con il proprio metodo e la latenza dell'intero batch
+        METRICS.record(methods[index], time.monotonic() - batch_start, error=None if exception is None else str(exception),
+                       throttled=exception is not None and _is_throttled(exception))
+        if exception is not None:
+            if _is_throttled(exception):
+                _count("throttled")
+            if attempt < MAX_RETRIES and _is_retryable(exception):
+                retry.append((index, exception))
+                return
+            _count("failed")
+        result = dict(operations[index], success=exception is None, error=None)
+        if exception is not None:
+            result.update(error=str(exception), retryable=_is_retryable(exception),
+                          status=exception.resp.status if isinstance(exception, HttpError) else None)
+        elif result["action"] == "create":
+            result["permission_id"] = (response or {}).get("id")
+        results[index] = result
+        progress.update()
+
+    while pending:
+        retry = []
+        for start in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[start:start + BATCH_SIZE]
+            batch = drive_service.new_batch_http_request(callback=callback)
+            try:
+                for index in chunk:
+                    request = _permission_request(drive_service, operations[index])
+                    methods[index] = request.methodId
+                    batch.add(request, request_id=str(index))
+                batch_start = time.monotonic()
+                execute(batch, cost=len(chunk))
+            except Exception as e:
+                # Errore dell'intero batch: le operazioni senza risposta vengono segnate come fallite
+                retrying = {i for i, _ in retry}
+                for index in chunk:
+                    if results[index] is None and index not in retrying:
+                        results[index] = dict(operations[index], success=False, error=str(e), retryable=_is_retryable(e),
+                                              status=e.resp.status if isinstance(e, HttpError) else None)
+                        progress.update()
+        if retry:
+            delay = max(_retry_delay(exception, attempt) for _, exception in retry)
+            if any(_is_throttled(exception) for _, exception in retry):
+                RATE_LIMITER.pause(delay)
+            _count("retried", len(retry))
+            time.sleep(delay)
+        pending = [index for index, _ in retry]
+        attempt += 1
+    progress.close()
+    update_stored_permissions(results)
+    return results
     
 
+def _permission_key(type, email):
+    """
+    Chiave che identifica il destinatario di un permesso, indipendentemente dal ruolo
+    """
+    return (type, (email or "").lower())
+
+
+def plan_drive_permissions(drive_id, current_permissions, new_permissions):
+    """
+    Calcolare le operazioni minime per portare i permessi di un drive da quelli attuali
+    a quelli desiderati (lista di dizionari con le chiavi "email", "type" e "role").
+    Restituisce una lista di operazioni con "action" 'keep', 'update', 'create' o 'delete'
+    """
+    plan = []
+    targets = {}
+    for permission in new_permissions:
+        targets[_permission_key(permission.get('type'), permission.get('email'))] = permission
+
+    for permission in current_permissions:
+        key = _permission_key(permission.get('type'), permission.get('emailAddress') or permission.get('domain'))
+        operation = {
+            "drive_id": drive_id,
+            "permission_id": permission.get('id'),
+            "email": key[1],
+            "type": key[0],
+            "role": permission.get('role'),
+        }
+        target = targets.pop(key, None)
+        if target is None:
+            operation["action"] = "delete"
+        elif target.get('role') == permission.get('role'):
+            operation["action"] = "keep"
+        else:
+            operation.update(action="update", role=target.get('role'), previous_role=permission.get('role'))
+        plan.append(operation)
+
+    for permission in targets.values():
+        plan.append({"action": "create", "drive_id": drive_id, **permission})
+    return plan
+
+
+def plan_permissions(drive_service, drive_ids, new_permissions, use_cache=False, workers=None):
+    """
+    Calcolare il piano di aggiornamento dei permessi di più drive condivisi.
+    Se use_cache è True i permessi attuali vengono letti dal database locale, quando presenti
+    """
+    current_permissions = {}
+    if use_cache:
+        for drive_id in drive_ids:
+            permissions = get_stored_drive_permissions(drive_id)
+            if permissions is not None:
+                current_permissions[drive_id] = permissions
+    missing = [drive_id for drive_id in drive_ids if drive_id not in current_permissions]
+    if missing:
+        print("Recupero permessi attuali...")
+        current_permissions.update(fetch_drives_permissions(drive_service, missing, workers))
+
+    plan = []
+    for drive_id in drive_ids:
+        if drive_id not in current_permissions:
+            print(f"Drive {drive_id} escluso: impossibile recuperare i permessi attuali")
+            continue
+        plan.extend(plan_drive_permissions(drive_id, current_permissions[drive_id], new_permissions))
+    return plan
+
+
+def enqueue_permission_operations(operations):
+    """
+    Accodare operazioni sui permessi (nel formato di execute_permission_batch) nella coda
+    salvata nel database locale. Le operazioni di uno stesso drive vengono eseguite nell'ordine indicato
+    """
+    with _transaction() as db:
+        db.executemany("INSERT INTO jobs (drive_id, operation, status) VALUES (?, ?, 'pending')",
+                       [(operation['drive_id'], json.dumps(operation)) for operation in operations])
+
+
+def count_permission_jobs():
+    """
+    Contare le operazioni in coda per stato: 'pending' (da eseguire), 'running' (in esecuzione)
+    e 'dead' (fallite definitivamente)
+    """
+    counts = {"pending": 0, "running": 0, "dead": 0}
+    counts.update(_query("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+    return counts
+
+
+def get_permission_jobs(status="dead"):
+    """
+    Ottenere le operazioni in coda con lo stato indicato, con il numero di tentativi e l'ultimo errore
+    """
+    rows = _query("SELECT id, operation, attempts, error FROM jobs WHERE status = ? ORDER BY id", (status,))
+    return [dict(json.loads(operation), job_id=job_id, attempts=attempts, error=error)
+            for job_id, operation, attempts, error in rows]
+
+
+def retry_dead_permission_jobs():
+    """
+    Rimettere in coda le operazioni fallite definitivamente. Restituisce il numero di operazioni
+    """
+    with _transaction() as db:
+        return db.execute("UPDATE jobs SET status = 'pending', attempts = 0 WHERE status = 'dead'").rowcount
+
+
+def clear_permission_jobs(status):
+    """
+    Eliminare le operazioni in coda con lo stato indicato. Restituisce il numero di operazioni
+    """
+    with _transaction() as db:
+        return db.execute("DELETE FROM jobs WHERE status = ?", (status,)).rowcount
+
+
+def _claim_permission_jobs():
+    """
+    Prendere in carico la prima operazione in sospeso di ogni drive che non ha già un'operazione in esecuzione,
+    segnandola come 'running' nella stessa istruzione che la seleziona: un altro processo che esegue la coda
+    nello stesso momento non può prendere le stesse operazioni. Le operazioni prese in carico da più
+    di JOB_CLAIM_TIMEOUT secondi (da un processo interrotto) tornano eseguibili
+    """
+    now = time.time()
+    with _transaction() as db:
+        rows = db.execute("UPDATE jobs SET status = 'running', claimed = ? WHERE id IN "
+                          "(SELECT MIN(id) FROM jobs WHERE status IN ('pending', 'running') GROUP BY drive_id) "
+                          "AND (status = 'pending' OR claimed < ?) RETURNING id, operation, attempts",
+                          (now, now - JOB_CLAIM_TIMEOUT)).fetchall()
+    return [(job_id, json.loads(operation), attempts) for job_id, operation, attempts in sorted(rows)]
+
+
+def _release_permission_jobs(job_ids):
+    """
+    Rimettere in sospeso le operazioni prese in carico e non ancora eseguite
+    """
+    with _transaction() as db:
+        db.executemany("UPDATE jobs SET status = 'pending', claimed = NULL WHERE id = ? AND status = 'running'",
+                       [(job_id,) for job_id in job_ids])
+
+
+def _run_permission_jobs_batch(drive_service, jobs):
+    """
+    Eseguire un batch di operazioni in coda ([(id, operazione, tentativi)]) e salvarne lo stato.
+    Quando un'operazione fallisce definitivamente anche le operazioni successive dello stesso drive
+    vengono segnate come fallite, così che ad esempio un membro non venga rimosso se l'aggiunta
+    del suo sostituto è fallita; jobs --retry-dead le rimette in coda nell'ordine originale.
+    Restituisce i risultati delle operazioni completate o fallite definitivamente
+    """
+    results = execute_permission_batch(drive_service, [operation for _, operation, _ in jobs], show_progress=False)
+    completed = []
+    done = []
+    updates = []
+    dead = []
+    removed = []
+    for (job_id, _, attempts), result in zip(jobs, results):
+        # Una rimozione ripetuta dopo un'interruzione può trovare il permesso già rimosso
+        if not result['success'] and result['action'] == "delete" and result.get('status') == 404:
+            result.update(success=True, error=None)
+            removed.append(result)
+        attempts += 1
+        if result['success']:
+            done.append((job_id,))
+        elif result.get('retryable', True) and attempts < JOB_MAX_ATTEMPTS:
+            updates.append(("pending", attempts, result['error'], job_id))
+            continue
+        else:
+            updates.append(("dead", attempts, result['error'], job_id))
+            dead.append((result['drive_id'], job_id))
+        completed.append(result)
+    # I permessi già rimossi vengono tolti anche da quelli salvati
+    update_stored_permissions(removed)
+    with _transaction() as db:
+        db.executemany("DELETE FROM jobs WHERE id = ?", done)
+        db.executemany("UPDATE jobs SET status = ?, attempts = ?, error = ? WHERE id = ?", updates)
+        for drive_id, job_id in dead:
+            error = f"Operazione precedente sul drive fallita (job {job_id})"
+            rows = db.execute("UPDATE jobs SET status = 'dead', error = ? WHERE drive_id = ? AND id > ? "
+                              "AND status = 'pending' RETURNING operation", (error, drive_id, job_id)).fetchall()
+            completed.extend(dict(json.loads(operation), success=False, error=error, retryable=False)
+                             for operation, in rows)
+    return completed
+
+
+def run_permission_jobs(drive_service, workers=None):
+    """
+    Eseguire le operazioni sui permessi in coda. A ogni giro viene eseguita la prima operazione
+    in sospeso di ogni drive, in batch da BATCH_SIZE e con al più workers batch contemporaneamente:
+    le operazioni di uno stesso drive restano in ordine mentre i drive diversi procedono in parallelo.
+    Le operazioni vengono prese in carico prima di eseguirle, quindi più processi possono eseguire la coda insieme.
+    Le operazioni fallite vengono ritentate nei giri successivi e dopo JOB_MAX_ATTEMPTS esecuzioni
+    (o subito, se l'errore non è temporaneo) restano in coda come fallite definitivamente.
+    Lo stato viene salvato dopo ogni batch, così un'esecuzione interrotta riprende dalle operazioni mancanti.
+    Restituisce i risultati delle operazioni completate o fallite definitivamente
+    """
+    results = []
+    counts = count_permission_jobs()
+    total = counts["pending"] + counts["running"]
+    if not total:
+        return results
+    executor = ThreadPoolExecutor(max_workers=max(1, workers or WORKERS))
+    progress = tqdm(total=total)
+    jobs = []
+    try:
+        while True:
+            jobs = _claim_permission_jobs()
+            if not jobs:
+                break
+            batches = [jobs[start:start + BATCH_SIZE] for start in range(0, len(jobs), BATCH_SIZE)]
+            for completed in executor.map(lambda batch: _run_permission_jobs_batch(drive_service, batch), batches):
+                results.extend(completed)
+                progress.update(len(completed))
+    finally:
+        progress.close()
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Le operazioni di un giro interrotto restano eseguibili per la prossima ripresa
+        _release_permission_jobs([job_id for job_id, _, _ in jobs])
+    return results
+
+
+def apply_permission_plan(drive_service, plan, workers=None):
+    """
+    Eseguire un piano di aggiornamento dei permessi attraverso la coda delle operazioni,
+    insieme alle eventuali operazioni rimaste in sospeso da un'esecuzione interrotta.
+    Per ogni drive le aggiunte e le modifiche vengono eseguite prima delle rimozioni, così che i membri
+    mantenuti non perdano mai l'accesso. Restituisce i risultati delle singole operazioni
+    """
+    operations = [operation for operation in plan if operation['action'] != "keep"]
+    # L'ordinamento è stabile: l'ordine delle operazioni dello stesso tipo non cambia
+    enqueue_permission_operations(sorted(operations, key=lambda operation: operation['action'] == "delete"))
+    print("Aggiornamento permessi...")
+    return run_permission_jobs(drive_service, workers)
+
+
+def _files_fields(fields):
+    """
+    Costruire il parametro fields di files().list, includendo i campi necessari alla visita
+    """
+    fields = list(dict.fromkeys(["id", "mimeType", "parents"] + list(fields)))
+    return f"nextPageToken, files({', '.join(fields)})"
+
+
+def iter_files_in_folder(drive_service, folderId, pages=False, fields=None, prefetch=True):
+    """
+    Restituire uno alla volta i file presenti in una cartella (o le pagine, se pages è True), man mano che vengono recuperati.
+    Se specificato, fields è l'elenco dei campi dei file da recuperare.
+    Se prefetch è False la pagina successiva non viene richiesta in anticipo (da usare nei worker di un pool)
+    """
+    files_fields = _files_fields(fields) if fields else "nextPageToken, files(id, name)"
+    request = drive_service.files().list(q=f"'{folderId}' in parents and trashed=false", spaces="drive", fields=files_fields, pageSize=1000, includeTeamDriveItems=True, supportsAllDrives=True)
+    return paginate(drive_service, "files", request, "files", pages=pages, prefetch=prefetch)
+
+
 def get_files_in_folder(drive_service, folderId):
     """
     Ottenere tutti i file presenti in una cartella
     """
-    files = []
-    request = drive_service.files().list(q=f"'{folderId}' in parents and trashed=false", spaces="drive", fields="nextPageToken, files(id, name)", includeTeamDriveItems=True, supportsAllDrives=True)
-    while request is not None:
-        response = request.execute()
-        files.extend(response.get('files', []))
-        request = drive_service.files().list_next(previous_request=request, previous_response=response)
-    return files
+    return list(iter_files_in_folder(drive_service, folderId))
     
   
-def get_all_users(directory_service):
+def list_drive_files(drive_service, drive_id, fields=WALK_FIELDS):
+    """
+    Restituire uno alla volta tutti i file di un drive condiviso, a qualsiasi profondità,
+    con una sola interrogazione paginata sull'intero drive (corpora=drive)
+    """
+    request = drive_service.files().list(
+        corpora="drive",
+        driveId=drive_id,
+        q="trashed=false",
+        includeItemsFromAllDrives=True,
+        supportsAllDrives=True,
+        pageSize=1000,
+        fields=_files_fields(fields)
+    )
+    return paginate(drive_service, "files", request, "files")
+
+
+def _walk_drive(drive_service, drive_id, max_depth, fields):
+    """
+    Visitare un drive condiviso elencandone tutti i file e ricostruendo la profondità dai parents
+    """
+    if max_depth is None:
+        yield from list_drive_files(drive_service, drive_id, fields)
+        return
+    files = list(list_drive_files(drive_service, drive_id, fields))
+    parents = {file['id']: (file.get('parents') or [None])[0] for file in files}
+    depths = {drive_id: 0}
+
+    def depth(file_id):
+        chain = []
+        while file_id not in depths:
+            if file_id not in parents:
+                return None
+            chain.append(file_id)
+            file_id = parents[file_id]
+        for index, chain_id in enumerate(reversed(chain)):
+            depths[chain_id] = depths[file_id] + index + 1
+        return depths[chain[0]] if chain else depths[file_id]
+
+    for file in files:
+        file_depth = depth(file['id'])
+        if file_depth is not None and file_depth <= max_depth:
+            yield dict(file, depth=file_depth)
+
+
+def walk_folder(drive_service, folder_id, max_depth=None, fields=WALK_FIELDS, workers=None, fast=False):
+    """
+    Restituire uno alla volta i file di una cartella e delle sue sottocartelle, visitate in ampiezza
+    con al più workers richieste in parallelo. Ogni file contiene la chiave "depth" (1 per i figli diretti).
+    Se max_depth è specificato le sottocartelle più profonde non vengono visitate.
+    Se fast è True e folder_id è l'id di un drive condiviso, il drive viene elencato con un'unica
+    interrogazione paginata e la struttura viene ricostruita dai parents: senza max_depth i file
+    vengono restituiti man mano che arrivano, ma senza la chiave "depth"
+    """
+    if fast:
+        yield from _walk_drive(drive_service, folder_id, max_depth, fields)
+        return
+
+    def fetch(folder_id):
+        # Senza prefetch ogni worker esegue una sola richiesta alla volta
+        return list(iter_files_in_folder(drive_service, folder_id, fields=fields, prefetch=False))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers or WORKERS))
+    try:
+        pending = {executor.submit(fetch, folder_id): 1}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                for file in future.result():
+                    if file.get('mimeType') == FOLDER_MIME_TYPE and (max_depth is None or depth < max_depth):
+                        pending[executor.submit(fetch, file['id'])] = depth + 1
+                    yield dict(file, depth=depth)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _compact_id(item_id):
+    """
+    Ridurre un id a un intero di 64 bit, che occupa meno memoria della stringa nell'insieme degli id già visti
+    """
+    return int.from_bytes(hashlib.blake2b(item_id.encode(), digest_size=8).digest(), "little")
+
+
+def merge_listings(sources, counts=None):
+    """
+    Elencare contemporaneamente gli elementi di più sorgenti ({id sorgente: elementi}) e restituirli
+    uno alla volta man mano che arrivano, senza ripetere quelli raggiungibili da più sorgenti.
+    Ogni sorgente viene letta da un proprio thread, perché limita già da sé le richieste in parallelo.
+    Ogni elemento riceve la chiave "source" con la sorgente da cui è arrivato per primo.
+    Se specificato, counts viene aggiornato con gli elementi e i duplicati di ogni sorgente
+    e con l'eventuale errore che ne ha interrotto l'elenco
+    """
+    counts = {} if counts is None else counts
+    results = queue.Queue(maxsize=MERGE_BUFFER)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def consume(source, elements):
+        try:
+            for element in elements:
+                if not put((source, element)):
+                    return
+        except Exception as e:
+            put((source, e))
+        finally:
+            put((source, done))
+
+    executor = ThreadPoolExecutor(max_workers=max(1, len(sources)))
+    try:
+        for source, elements in sources.items():
+            counts[source] = {"elements": 0, "duplicates": 0, "error": None}
+            executor.submit(consume, source, elements)
+        seen = set()
+        remaining = len(sources)
+        while remaining:
+            source, element = results.get()
+            if element is done:
+                remaining -= 1
+            elif isinstance(element, Exception):
+                counts[source]["error"] = str(element)
+            else:
+                counts[source]["elements"] += 1
+                key = _compact_id(element.get('id', ""))
+                if key in seen:
+                    counts[source]["duplicates"] += 1
+                    continue
+                seen.add(key)
+                element['source'] = source
+                yield element
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_all_users(directory_service, pages=False):
+    """
+    Restituire uno alla volta gli utenti del dominio dalla Directory API (o le pagine, se pages è True),
+    man mano che vengono recuperati
+    """
+    request = directory_service.users().list(customer='my_customer', maxResults=500, fields=USER_FIELDS)
+    return paginate(directory_service, "users", request, "users", pages=pages)
+
+
+def _fetch_all_users(directory_service):
+    """
+    Recuperare tutti gli utenti del dominio dalla Directory API
+    """
+    return list(iter_all_users(directory_service))
+
+
+def _load_users(directory_service, refresh=False):
+    """
+    Salvare nel database gli utenti del dominio, recuperandoli di nuovo
+    solo se sono trascorsi più di USERS_CACHE_TTL secondi dall'ultimo recupero
+    """
+    updated = float(get_metadata("users_updated") or 0)
+    if refresh or time.time() - updated > USERS_CACHE_TTL:
+        print("Recupero utenti...")
+        store_users(_fetch_all_users(directory_service))
+
+
+def get_user_models(directory_service, refresh=False):
+    """
+    Ottenere gli utenti del dominio come oggetti User (da non modificare), senza copiarli in dizionari
+    """
+    _load_users(directory_service, refresh)
+    return _user_models()
+
+
+def get_all_users(directory_service, refresh=False):
     """
     Ottenere tutti gli utenti del dominio
     """
-    users = []
-    request = directory_service.users().list(customer='my_customer', maxResults=200)
-    while request is not None:
-        response = request.execute()
-        users.extend(response.get('users', []))
-        request = directory_service.users().list_next(previous_request=request, previous_response=response)
-    return users
+    return [user.to_dict() for user in get_user_models(directory_service, refresh)]
+
+
+def get_emails_from_ids(directory_service, user_ids):
+    """
+    Ottenere le email di più utenti a partire dai loro id.
+    Restituisce un dizionario {id: email}, con None per gli utenti non trovati
+    """
+    _load_users(directory_service)
+    emails = {}
+    for user_id in user_ids:
+        rows = _query("SELECT primary_email FROM users WHERE id = ?", (user_id,))
+        emails[user_id] = rows[0][0] if rows else None
+    return emails
+
+
+def get_ids_from_emails(directory_service, emails):
+    """
+    Ottenere gli id di più utenti a partire dalle loro email (primarie o alias).
+    Restituisce un dizionario {email: id}, con None per gli utenti non trovati
+    """
+    _load_users(directory_service)
+    user_ids = {}
+    for email in emails:
+        rows = _query("SELECT user_id FROM user_emails WHERE email = ?", (email,))
+        user_ids[email] = rows[0][0] if rows else None
+    return user_ids
 
 
 def get_email_from_id(directory_service, user_id):
     """
     Ottenere l'email di un utente con un determinato id
     """
-    users = get_all_users(directory_service)
-    for user in users:
-        if user.get('id') == user_id:
-            return user.get('primaryEmail')
-    print(f"Utente con userId {user_id} non trovato")
-    return None
+    email = get_emails_from_ids(directory_service, [user_id])[user_id]
+    if email is None:
+        print(f"Utente con userId {user_id} non trovato")
+    return email
   
 
 def get_id_from_email(directory_service, email):
     """
     Ottenere l'id di un utente con una determinata email
     """
-    users = get_all_users(directory_service)
-    for user in users:
-        if user.get('primaryEmail') == email:
-            return user.get('id')
-    print(f"Utente con email {email} non trovato.")
-    return None
+    user_id = get_ids_from_emails(directory_service, [email])[email]
+    if user_id is None:
+        print(f"Utente con email {email} non trovato.")
+    return user_id
   
   
+def get_drives_shared_with_members(drive_service, emails):
+    """
+    Ottenere l'elenco dei drive condivisi con ciascuno degli utenti/gruppi indicati.
+    Restituisce un dizionario {email: drive}
+    """
+    # Assicura che drive e permessi siano presenti nel database locale
+    if not get_metadata("permissions_loaded"):
+        update_data(drive_service)
+
+    members_drives = {}
+    for email in emails:
+        rows = _query("SELECT DISTINCT p.drive_id, d.data FROM permissions p LEFT JOIN drives d ON d.id = p.drive_id "
+                      "WHERE p.email = ? ORDER BY d.rowid", (email,))
+        members_drives[email] = [json.loads(data) if data else {"id": drive_id} for drive_id, data in rows]
+    return members_drives
+
+
+def search_files_shared_with_member(drive_service, email, fields=("id", "name", "driveId")):
+    """
+    Restituire uno alla volta i file di tutti i drive condivisi accessibili a un utente/gruppo,
+    cercandoli direttamente con la Drive API ('email' in readers/writers)
+    """
+    email = email.replace("\\", "\\\\").replace("'", "\\'")
+    request = drive_service.files().list(
+        q=f"('{email}' in readers or '{email}' in writers) and trashed=false",
+        corpora="allDrives",
+        includeItemsFromAllDrives=True,
+        supportsAllDrives=True,
+        pageSize=1000,
+        fields=f"nextPageToken, files({','.join(fields)})"
+    )
+    return paginate(drive_service, "files", request, "files")
+
+
+def search_drives_shared_with_members(drive_service, emails):
+    """
+    Ottenere i drive condivisi con ciascuno degli utenti/gruppi indicati interrogando direttamente
+    la Drive API, invece di scorrere i permessi di tutti i drive.
+    drives().list non permette di filtrare per membro, quindi i drive vengono ricavati dai file
+    accessibili al membro: la ricerca costa una richiesta ogni 1000 file visibili al membro
+    e il risultato è parziale, perché files().list non supporta useDomainAdminAccess
+    (i drive di cui l'utente autenticato non è membro non vengono cercati) e i drive vuoti non hanno file.
+    Per le email con cui l'interrogazione non è supportata vengono usati i dati salvati.
+    Restituisce il dizionario {email: drive} e gli id dei drive che non è stato possibile cercare
+    """
+    visible_drives = {drive['id']: drive for drive in _fetch_all_drives(drive_service)}
+    unsearched = [drive['id'] for drive in _fetch_all_drives(drive_service, True) if drive['id'] not in visible_drives]
+    members_drives = {}
+    unsupported = []
+    for email in emails:
+        try:
+            files = search_files_shared_with_member(drive_service, email, fields=["driveId"])
+            drive_ids = list(dict.fromkeys(file['driveId'] for file in files if file.get('driveId')))
+        except HttpError as e:
+            if e.resp.status != 400:
+                raise
+            unsupported.append(email)
+            continue
+        members_drives[email] = [visible_drives.get(drive_id, {"id": drive_id}) for drive_id in drive_ids]
+    if unsupported:
+        members_drives.update(get_drives_shared_with_members(drive_service, unsupported))
+    return {email: members_drives[email] for email in emails}, unsearched
+
+
 def get_drives_shared_with_member(drive_service, user_email):
     """
     Ottenere l'elenco di tutti i drive condivisi con un determinato utente/gruppo
     """
-    shared_drives = get_all_drives(drive_service, True)
-    permissions = get_all_drives_permissions(drive_service)
-    
-    user_shared_drives = []
-    
-    for drive in shared_drives:
-        drive_id = drive.get('id')
-        for permission in permissions.get(drive_id).get('permissions'):
-  
-          if permission.get('emailAddress') == user_email:
-              user_shared_drives.append(drive)
-              break
-    
-    return user_shared_drives
-  
+    return get_drives_shared_with_members(drive_service, [user_email])[user_email]
+
+
+def _audit_drives(drives, internal_domains, suspended):
+    """
+    Analizzare i permessi di un gruppo di drive ([(id, nome, [(email, dominio, tipo, ruolo)])]).
+    Restituisce le segnalazioni e il numero di drive di ogni utente/gruppo
+    """
+    findings = []
+    members = Counter()
+    for drive_id, drive_name, permissions in drives:
+        if not any(role == "organizer" for _, _, _, role in permissions):
+            findings.append({"report": "no_organizer", "drive_id": drive_id, "drive_name": drive_name})
+        for email, domain, type, role in permissions:
+            finding = {"drive_id": drive_id, "drive_name": drive_name, "type": type, "role": role}
+            if type in ["user", "group"] and email:
+                email = email.lower()
+                members[(type, email)] += 1
+                if email.rsplit("@", 1)[-1] not in internal_domains:
+                    findings.append(dict(finding, report="external_member", email=email))
+                elif type == "user" and email in suspended:
+                    findings.append(dict(finding, report="suspended_user", email=email))
+            elif type == "anyone" or (type == "domain" and (domain or "").lower() not in internal_domains):
+                findings.append(dict(finding, report="external_member", email=domain))
+    return findings, members
+
+
+def audit_domain(drive_service, directory_service, workers=None, domains=()):
+    """
+    Analizzare in un solo passaggio i permessi salvati di tutti i drive e gli utenti del dominio.
+    Restituisce una alla volta le segnalazioni, distinte dalla chiave "report":
+    'no_organizer' (drive senza organizzatori), 'external_member' (membri esterni ai domini
+    degli utenti o a quelli indicati in domains), 'suspended_user' (utenti sospesi con accesso a un drive)
+    e infine 'member_drives' (numero di drive di ogni utente/gruppo, dal più alto).
+    Oltre AUDIT_PARALLEL_THRESHOLD permessi i drive vengono suddivisi tra workers processi
+    """
+    if not get_metadata("permissions_loaded"):
+        update_data(drive_service)
+    _load_users(directory_service)
+    internal_domains = {domain.lower() for domain in domains}
+    suspended = set()
+    for user in _user_models():
+        emails = [email.lower() for email in [user.email, *user.aliases] if email]
+        internal_domains.update(email.rsplit("@", 1)[-1] for email in emails)
+        if user.suspended:
+            suspended.update(emails)
+
+    names = {drive.id: drive.name for drive in _drive_models()}
+    drives = [(drive_id, names.get(drive_id), [(p.email, p.domain, p.type, p.role) for p in permissions])
+              for drive_id, permissions in _permission_models().items()]
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and sum(len(permissions) for _, _, permissions in drives) >= AUDIT_PARALLEL_THRESHOLD:
+        size = -(-len(drives) // (workers * AUDIT_CHUNKS_PER_WORKER))
+        members = Counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_audit_drives, drives[i:i + size], internal_domains, suspended)
+                       for i in range(0, len(drives), size)]
+            for future in as_completed(futures):
+                findings, chunk_members = future.result()
+                members.update(chunk_members)
+                yield from findings
+    else:
+        findings, members = _audit_drives(drives, internal_domains, suspended)
+        yield from findings
+    for (type, email), count in members.most_common():
+        yield {"report": "member_drives", "type": type, "email": email, "drives": count}
+
+
+# Campi esportabili: intestazione -> chiave (anche annidata, es. 'name.fullName' o 'parents.0') o funzione
+DRIVE_EXPORT_FIELDS = {
+    "Id": "id",
+    "Nome": "name",
+}
+FILE_EXPORT_FIELDS = {
+    "Id": "id",
+    "Nome": "name",
+}
+TREE_EXPORT_FIELDS = {
+    "Id": "id",
+    "Nome": "name",
+    "Tipo": "mimeType",
+    "Cartella": "parents.0",
+    "Profondità": "depth",
+}
+DIFF_EXPORT_FIELDS = {
+    "Drive": "drive_id",
+    "Nome drive": "drive_name",
+    "Modifica": "change",
+    "Tipo": "type",
+    "Email": "email",
+    "Ruolo": "role",
+    "Ruolo precedente": "previous_role",
+}
+AUDIT_EXPORT_FIELDS = {
+    "Report": "report",
+    "Drive": "drive_id",
+    "Nome drive": "drive_name",
+    "Email": "email",
+    "Tipo": "type",
+    "Ruolo": "role",
+    "Numero drive": "drives",
+}
+USER_EXPORT_FIELDS = {
+    "Id": "id",
+    "Email": "email",
+    "Nome": "name",
+    "Admin": lambda user: 'SI' if user.admin else 'NO',
+    "Stato": lambda user: 'ATTIVO' if not user.suspended else 'SOSPESO',
+}
+
+
+def _field_value(item, field):
+    """
+    Estrarre da un elemento il valore di un campo da esportare
+    """
+    if callable(field):
+        return field(item)
+    value = item
+    for key in field.split('.'):
+        if isinstance(value, list) and key.isdigit():
+            value = value[int(key)] if int(key) < len(value) else None
+        elif isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, (Drive, Permission, User)):
+            value = getattr(value, key, None)
+        else:
+            return None
+    return value
+
+
+def export_items(items, filename, fields, format="csv", compress=False):
+    """
+    Esportare gli elementi di un iterabile (anche un generatore) in un file CSV o JSONL,
+    scrivendo ogni riga non appena l'elemento è disponibile.
+    fields è un dizionario {intestazione: campo} come DRIVE_EXPORT_FIELDS; gli elementi possono essere
+    dizionari od oggetti Drive, Permission e User.
+    Se compress è True il file viene compresso con gzip.
+    Restituisce il numero di elementi esportati
+    """
+    if compress:
+        file = gzip.open(filename, 'wt', encoding='utf-8', newline='')
+    else:
+        file = open(filename, 'w', encoding='utf-8', newline='')
+    count = 0
+    with file:
+        if format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(fields.keys())
+        for item in items:
+            values = [_field_value(item, field) for field in fields.values()]
+            if format == "csv":
+                writer.writerow(['N/A' if value is None else value for value in values])
+            else:
+                file.write(json.dumps(dict(zip(fields.keys(), values)), ensure_ascii=False) + "\n")
+            count += 1
+    return count